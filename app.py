@@ -1,27 +1,45 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from flask import Flask, request, render_template, send_from_directory, jsonify
+import startup_timing   # first, so STARTUP_TIMING=1 can time the imports below
+import atexit, fcntl, logging
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from flask import Flask, Response, request, render_template, send_file, jsonify
 from werkzeug.utils import secure_filename
 from PIL import Image, ImageDraw, ImageFont
-import os, uuid, socket, re
+import os, uuid, socket, re, hashlib, threading, mimetypes, tempfile, tarfile, zipfile, json, random, time, functools
 from datetime import datetime
 from io import BytesIO
-try:
-    from waveshare_epd import epd7in3e
-except Exception as exc:
-    epd7in3e = None
-    EPD_IMPORT_ERROR = exc
-else:
-    EPD_IMPORT_ERROR = None
-from huggingface_hub import InferenceClient
-from dotenv import load_dotenv
+from waveshare_epd import orientation, palette
+from upload_index import UploadIndex, SOURCES
+from thumbnails import ThumbnailCache
+from blob_store import BlobStore, UploadTooLarge, UnsupportedImage
+from retention import RetentionPolicy
+from storage_codec import StorageCodec
+import archives
+from generation import RUNNING, GenerationCache, GenerationService, JobStore
+from inference import ResilientInference
+from events import EventBus
+from metrics import Registry
+from tracing import Tracer
+from profiling import ProfileStore
+from panel_owner import PanelBusy, PanelOwner
+from display_daemon import DisplayClient, DisplayDaemonError
+# huggingface_hub is imported by get_client() on the first generation: it is
+# the slowest import by far and the panel should show its IP without waiting
 
 # ---------------------------------------------------------------------------
 # setup
 # ---------------------------------------------------------------------------
 
-load_dotenv()
+try:
+    from dotenv import load_dotenv
+except ImportError:
+    pass    # python-dotenv is optional; plain environment variables still work
+else:
+    load_dotenv()
+startup_timing.mark("imports and .env")
 
 
 def _env_or_default(name, default=""):
@@ -35,6 +53,23 @@ def _int_env(name, fallback):
     except (TypeError, ValueError):
         return fallback
 
+# with a display daemon (display_daemon.py) this process never touches the
+# panel: importing the driver already claims its GPIO lines (epdconfig), which
+# the daemon owns, so the driver is only imported without DISPLAY_SOCKET
+DISPLAY_SOCKET = _env_or_default("DISPLAY_SOCKET", "")
+if DISPLAY_SOCKET:
+    epd7in3e = None
+    EPD_IMPORT_ERROR = RuntimeError("the panel is driven by the display daemon")
+else:
+    try:
+        from waveshare_epd import epd7in3e
+    except Exception as exc:
+        epd7in3e = None
+        EPD_IMPORT_ERROR = exc
+    else:
+        EPD_IMPORT_ERROR = None
+    startup_timing.mark("panel driver import")
+
 HF_API_KEY  = os.getenv("HF_API_KEY")
 
 SUPPORTED_MODELS = [
@@ -42,17 +77,27 @@ SUPPORTED_MODELS = [
     {"id": "stabilityai/stable-diffusion-xl-base-1.0", "label": "Stable Diffusion XL Base"},
     {"id": "stabilityai/stable-diffusion-3-medium-diffusers", "label": "Stable Diffusion 3 Medium"},
 ]
+# latent size granularity: width/height must be multiples of this (VAE
+# downsampling x patch size); unknown models get the SD value of 8
+MODEL_SIZE_MULTIPLE = {
+    "black-forest-labs/FLUX.1-schnell": 16,
+    "stabilityai/stable-diffusion-3-medium-diffusers": 16,
+    "stabilityai/stable-diffusion-xl-base-1.0": 8,
+}
 DEFAULT_MODEL_ID = SUPPORTED_MODELS[0]["id"]
-CHIP_LABELS = {
-    "poster",
-    "typography",
-    "landscape",
-    "architecture",
-    "product",
-    "infographic",
-    "portrait",
-    "doodle",
+# prompt templates behind the UI's preset chips; {SUBJECT} is filled in per
+# request, {ORIENTATION} and {SIZE} once the panel size is known (PROMPT_PRESETS)
+PROMPT_TEMPLATES = {
+    "poster": "{SUBJECT} - bold minimalist poster, thick outlines, dramatic negative space, screen-print vibe, {ORIENTATION} {SIZE}.",
+    "typography": "{SUBJECT} - graphic typography layout, sans-serif lettering, tight kerning, white background, black letters with bright accent strokes, {ORIENTATION} {SIZE} composition.",
+    "landscape": "{SUBJECT} - stylized landscape illustration, simple geometric layers, high contrast, wide framing, clean vector style.",
+    "architecture": "{SUBJECT} - brutalist building illustration, sharp angles, heavy black lines on white, selective accent colour, {ORIENTATION} {SIZE}.",
+    "product": "{SUBJECT} - hero product render, centered object on pure white background, dramatic top lighting, crisp contour, poster-ready {ORIENTATION} {SIZE}.",
+    "infographic": "{SUBJECT} - minimalist infographic, clean grids, labeled sections, white canvas, black vector icons, balanced negative space.",
+    "portrait": "{SUBJECT} - stylized portrait bust, bold contour lines, white background, graphic shading, selective highlights, {ORIENTATION} {SIZE}.",
+    "doodle": "{SUBJECT} - playful hand-drawn doodle, thick black marker lines, sparse white background, pops of colour, offbeat composition.",
 }
+CHIP_LABELS = set(PROMPT_TEMPLATES)
 
 
 
@@ -104,24 +149,139 @@ for entry in SUPPORTED_MODELS:
     choice_map[clone["id"]] = clone
 MODEL_ID_LOOKUP = choice_map
 
-client = InferenceClient(
-    provider=HF_PROVIDER,
-    api_key=HF_API_KEY,
+HF_TIMEOUT  = _int_env("HF_TIMEOUT", 120)
+
+# point at a local stub server (POST <url>/models/<model id>) for testing
+HF_BASE_URL = _env_or_default("HF_BASE_URL", "").rstrip("/")
+HF_FALLBACK = _env_or_default("HF_FALLBACK", "1") not in ("0", "false", "no")
+
+client = None   # created by get_client() on first use
+_client_lock = threading.Lock()
+inference = ResilientInference(
+    retries=_int_env("HF_RETRIES", 2),
+    backoff=_int_env("HF_BACKOFF_MS", 1000) / 1000,
+    max_backoff=_int_env("HF_BACKOFF_MAX_MS", 20000) / 1000,
+    breaker_failures=_int_env("HF_BREAKER_FAILURES", 3),
+    breaker_reset=_int_env("HF_BREAKER_RESET_SEC", 60),
 )
 
 UPLOAD_FOLDER = "uploads"
-RESOLUTION    = (800, 480)          # for HF generation only
-GEN_WIDTH     = _int_env("HF_WIDTH", RESOLUTION[0])
-GEN_HEIGHT    = _int_env("HF_HEIGHT", RESOLUTION[1])
+DATA_FOLDER   = _env_or_default("DATA_FOLDER", "data")
+RESOLUTION    = (800, 480)          # when the driver isn't imported here (daemon's panel)
+UPLOAD_MAX_AGE = 365 * 24 * 3600    # timestamped names never change content
+UPLOAD_MAX_BYTES = _int_env("UPLOAD_MAX_MB", 25) * 1024 * 1024
+IMPORT_MAX_BYTES = _int_env("IMPORT_MAX_MB", 1024) * 1024 * 1024
+BULK_MAX_FILES = 1000
+GEN_BATCH_MAX = _int_env("GEN_BATCH_MAX", 16)
+GEN_STORAGE   = StorageCodec(
+    _env_or_default("GEN_STORAGE_FORMAT", "png"),
+    quality=_int_env("GEN_STORAGE_QUALITY", 90),
+    png_compress_level=_int_env("GEN_PNG_COMPRESS", 6),
+)
+EPD_ROTATION  = orientation.normalize_rotation(_env_or_default("EPD_ROTATION", "0"))
+EPD_MIRROR    = orientation.normalize_mirror(_env_or_default("EPD_MIRROR", "none"))
+# generate at the size the picture will be shown at: the attached panel in
+# its mounted orientation, unless HF_WIDTH/HF_HEIGHT override it
+PANEL_SIZE    = orientation.logical_size(
+    *((epd7in3e.EPD_WIDTH, epd7in3e.EPD_HEIGHT) if epd7in3e else RESOLUTION),
+    EPD_ROTATION,
+)
+# the presets ask for the layout the panel actually has, e.g. "portrait 480x800"
+PANEL_SHAPE   = ("landscape" if PANEL_SIZE[0] > PANEL_SIZE[1]
+                 else "portrait" if PANEL_SIZE[0] < PANEL_SIZE[1] else "square")
+PROMPT_PRESETS = {
+    name: text.replace("{ORIENTATION}", PANEL_SHAPE).replace("{SIZE}", "{}x{}".format(*PANEL_SIZE))
+    for name, text in PROMPT_TEMPLATES.items()
+}
+GEN_WIDTH     = _int_env("HF_WIDTH", PANEL_SIZE[0])
+GEN_HEIGHT    = _int_env("HF_HEIGHT", PANEL_SIZE[1])
+GEN_MIN_SIDE  = _int_env("GEN_MIN_SIDE", 256)   # small panels still need a usable latent
+
+# older Pythons don't map .webp, which would serve generated images as octet-stream
+mimetypes.add_type("image/webp", ".webp")
 
 app = Flask(__name__)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+# Werkzeug rejects larger bodies with 413 before we read them
+app.config["MAX_CONTENT_LENGTH"] = UPLOAD_MAX_BYTES + 1024 * 1024
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+startup_timing.mark("config")
+
+upload_index = UploadIndex(os.path.join(DATA_FOLDER, "uploads.db"), UPLOAD_FOLDER)
+# sweeps placeholders (see reserve_unique_filename) a crashed save left behind
+upload_index.sync(CHIP_LABELS, reserved_ttl=600)
+startup_timing.mark("upload index sync")
+blob_store = BlobStore(os.path.join(DATA_FOLDER, "blobs"))
+thumbnails = ThumbnailCache(
+    UPLOAD_FOLDER,
+    os.path.join(DATA_FOLDER, "thumbs"),
+    size=_int_env("THUMB_SIZE", 320),
+    max_bytes=_int_env("THUMB_CACHE_MB", 64) * 1024 * 1024,
+)
+# events and traces live in SQLite so every gunicorn worker serves them all
+ACTIVITY_DB = os.path.join(DATA_FOLDER, "activity.db")
+events = EventBus(ACTIVITY_DB)
+# every open /events stream holds a request thread for as long as its tab
+# stays open; keep some of gunicorn's --threads free for everything else
+EVENTS_MAX_CLIENTS = _int_env("EVENTS_MAX_CLIENTS", 4)
+_event_clients = threading.BoundedSemaphore(max(EVENTS_MAX_CLIENTS, 1))
+
+metrics = Registry()
+stage_seconds = metrics.histogram(
+    "epaper_stage_seconds", "Display pipeline stage durations in seconds")
+panel_refreshes = metrics.counter(
+    "epaper_panel_refreshes_total", "Panel refreshes by kind (this panel only does full ones)")
+for _kind in ("full", "partial", "skipped"):
+    panel_refreshes.inc(0, kind=_kind)
+generation_seconds = metrics.histogram(
+    "epaper_generation_seconds", "Inference call latency in seconds by model and outcome")
+
+# jobs slower than their threshold are logged in full to data/slow_jobs.log
+slow_job_log = logging.getLogger("epaper.slow_jobs")
+_slow_handler = RotatingFileHandler(
+    os.path.join(DATA_FOLDER, "slow_jobs.log"), maxBytes=1024 * 1024, backupCount=2)
+_slow_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+slow_job_log.addHandler(_slow_handler)
+tracer = Tracer(
+    ACTIVITY_DB,
+    keep=_int_env("TRACE_KEEP", 50),
+    slow={
+        "display": _int_env("SLOW_DISPLAY_SEC", 60),
+        "splash": _int_env("SLOW_DISPLAY_SEC", 60),
+        "generate": _int_env("SLOW_GENERATE_SEC", 90),
+    },
+    slow_logger=slow_job_log,
+)
+
+# cProfile single requests: "header" honours X-Profile (which must equal
+# PROFILE_TOKEN when one is set), "always" profiles every update, "off" never
+PROFILE_MODE = _env_or_default("PROFILE_MODE", "header").lower()
+PROFILE_TOKEN = _env_or_default("PROFILE_TOKEN", "")
+profiles = ProfileStore(
+    os.path.join(DATA_FOLDER, "diagnostics", "profiles"),
+    keep=_int_env("PROFILE_KEEP", 20),
+)
+
 # ---------------------------------------------------------------------------
 # helpers
 # ---------------------------------------------------------------------------
 
+def get_client():
+    global client
+    with _client_lock:
+        if client is None:
+            began = time.perf_counter()
+            from huggingface_hub import InferenceClient
+            client = InferenceClient(
+                provider=HF_PROVIDER,
+                api_key=HF_API_KEY,
+                timeout=HF_TIMEOUT,
+            )
+            app.logger.info("Inference client ready in %.0f ms",
+                            (time.perf_counter() - began) * 1000)
+        return client
+
 def get_ip() -> str:
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
@@ -154,15 +314,264 @@ def draw_ip_overlay(img, txt, pos, size, color):
     d.text((x, y), txt, font=fnt, fill=color)
     return img
 
+# one SPI conversation at a time, across threads and WSGI worker processes:
+# every panel user goes through panel_owner (set up below instrument_panel)
+_panel_updates = 0
+_panel_job = None       # (job id, phase) of the update owning the panel
+PANEL_IDLE_SEC = _int_env("PANEL_IDLE_SEC", 120)
+PANEL_LOCK_FILE = _env_or_default("PANEL_LOCK_FILE", os.path.join(DATA_FOLDER, "panel.lock"))
+PANEL_LOCK_TIMEOUT = _int_env("PANEL_LOCK_TIMEOUT", 300)
+# with a display daemon the picture is rendered here and its pixels handed
+# over the daemon's socket
+display_client = (DisplayClient(DISPLAY_SOCKET, timeout=_int_env("DISPLAY_TIMEOUT", 600))
+                  if DISPLAY_SOCKET else None)
+PANEL_STATE_PATH = os.path.join(DATA_FOLDER, "panel_state")
+SPLASH_CACHE_PATH = os.path.join(DATA_FOLDER, "splash.bin")
+
+def _read_panel_state() -> str:
+    try:
+        with open(PANEL_STATE_PATH, encoding="utf-8") as fh:
+            return fh.read().strip()
+    except OSError:
+        return ""
+
+def _write_panel_state(state: str) -> None:
+    # "" while a refresh is in flight, so a power cut never leaves a stale claim
+    tmp = PANEL_STATE_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        fh.write(state)
+    os.replace(tmp, PANEL_STATE_PATH)
+
+@contextmanager
+def pipeline_stage(name: str):
+    # one measurement for both /metrics and the current job's trace
+    with tracer.span(name), stage_seconds.time(stage=name):
+        yield
+
+def profiling_requested() -> bool:
+    if request.method != "POST" or PROFILE_MODE == "off":
+        return False
+    if PROFILE_MODE == "always":
+        return True
+    value = request.headers.get("X-Profile", "")
+    if PROFILE_TOKEN:
+        return value == PROFILE_TOKEN
+    return value.lower() in ("1", "true", "yes")
+
+def profiled(label: str):
+    # run the view under cProfile when asked to; the saved profile's name
+    # comes back in the X-Profile-Id response header
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not profiling_requested():
+                return view(*args, **kwargs)
+            rv, name = profiles.run(label, view, *args, **kwargs)
+            response = app.make_response(rv)
+            if name:
+                response.headers["X-Profile-Id"] = name
+            return response
+        return wrapper
+    return decorate
+
+def instrument_panel(panel) -> None:
+    # Time the driver's hot paths into epaper_stage_seconds and the job's
+    # trace, and report the SPI transfer and refresh of every update as
+    # stages of whichever job owns the panel. Methods a driver doesn't have
+    # are skipped; the calls the driver makes on itself (display() ->
+    # send_data2()) go through the wrappers because they are set on the
+    # instance.
+    def wrap(name, metric, stage=None):
+        method = getattr(panel, name, None)
+        if method is None:
+            return
+        def wrapper(*args, **kwargs):
+            current = _panel_job
+            if current and stage:
+                events.publish(current[0], "display", stage, phase=current[1])
+            with tracer.span(name), stage_seconds.time(stage=metric):
+                return method(*args, **kwargs)
+        setattr(panel, name, wrapper)
+    wrap("init", "panel_init")
+    wrap("Clear", "clear")
+    wrap("display", "display")
+    wrap("getbuffer", "getbuffer")
+    wrap("quantize", "quantize")
+    wrap("pack", "pack")
+    wrap("send_data2", "spi_transfer", "transferring")
+    wrap("TurnOnDisplay", "refresh", "panel busy")
+    wrap("ReadBusyH", "busy_wait")
+    wrap("ReadBusy", "busy_wait")
+    wrap("sleep", "sleep")
+
+def make_panel():
+    if epd7in3e is None:
+        raise RuntimeError(f"e-Paper driver unavailable: {EPD_IMPORT_ERROR}")
+    panel = epd7in3e.EPD()
+    instrument_panel(panel)
+    return panel
+
+panel_owner = PanelOwner(make_panel, PANEL_LOCK_FILE, idle=PANEL_IDLE_SEC,
+                         timeout=PANEL_LOCK_TIMEOUT or None)
+atexit.register(panel_owner.close)
+
+def _panel_phase(job, stage, phase=None):
+    global _panel_job
+    _panel_job = (job, phase or stage)
+    events.publish(job, "display", stage)
+
+def panel_native_size():
+    if display_client is not None:
+        return display_client.panel_size()
+    epd = panel_owner.panel
+    return epd.width, epd.height
+
+def _send_to_daemon(pil, job) -> bool:
+    # the daemon quantizes, packs and refreshes; the RGB pixels are copied
+    # into a memfd once instead of being streamed through the socket
+    global _panel_updates
+    _panel_updates += 1
+    _write_panel_state("")
+    events.publish(job, "display", "sending to display daemon")
+    with tracer.span("display daemon"), stage_seconds.time(stage="daemon"):
+        reply = display_client.show_pixels(pil, clear=True)
+    _write_panel_state("image")
+    panel_refreshes.inc(kind="full")
+    return reply.get("warm", False)
+
 def send_to_display(pil, *, overlay=False, pos=(10, 10),
-                    fsize=18, fcolor=(0, 0, 0), text=""):
-    pil = pil.resize((epd.width, epd.height)).convert("RGB")
-    if overlay and text:
-        pil = draw_ip_overlay(pil, text, pos, fsize, fcolor)
-    epd.init()
-    epd.Clear()
-    epd.display(epd.getbuffer(pil))
-    epd.sleep()
+                    fsize=18, fcolor=(0, 0, 0), text="", job=None):
+    global _panel_updates, _panel_job
+    job = job or uuid.uuid4().hex
+    try:
+        events.publish(job, "display", "converting")
+        with pipeline_stage("resize"):
+            # resize on the logical canvas, then transpose the (smaller) result once
+            canvas_size = orientation.logical_size(*panel_native_size(), EPD_ROTATION)
+            pil = pil.resize(canvas_size).convert("RGB")
+            if overlay and text:
+                pil = draw_ip_overlay(pil, text, pos, fsize, fcolor)
+            pil = orientation.apply(pil, EPD_ROTATION, EPD_MIRROR)
+        if display_client is not None:
+            warm = _send_to_daemon(pil, job)
+            events.publish(job, "display", "done", warm=warm)
+            return
+        epd = panel_owner.panel
+        buf = epd.getbuffer(pil)
+        with tracer.span("wait for panel"):
+            session = panel_owner.acquire(
+                on_wait=lambda: events.publish(job, "display", "waiting for panel"))
+        try:
+            _panel_updates += 1
+            _write_panel_state("")
+            _panel_phase(job, "panel init")
+            warm = not session.wake()
+            _panel_phase(job, "clearing", "clear")
+            epd.Clear()
+            _panel_phase(job, "drawing", "image")
+            epd.display(buf)
+            session.done()
+            _write_panel_state("image")
+            panel_refreshes.inc(kind="full")
+        except Exception:
+            session.failed()
+            raise
+        finally:
+            _panel_job = None
+            panel_owner.release()
+    except Exception as exc:
+        events.publish(job, "display", "failed", error=str(exc))
+        raise
+    events.publish(job, "display", "done", warm=warm)
+
+def splash_image(native_size, ip: str):
+    # the IP splash, oriented for a panel of the given native size
+    size = orientation.logical_size(*native_size, EPD_ROTATION)
+    startup = Image.new("RGB", size, (255, 255, 255))
+    draw_ip_overlay(startup, f"IP: {ip}", "top-left", 24, (0, 0, 0))
+    return orientation.apply(startup, EPD_ROTATION, EPD_MIRROR)
+
+def splash_buffer(key: str, ip: str):
+    # The packed panel buffer for the IP splash. Quantizing and packing
+    # 800x480 in Python takes seconds on a Pi Zero, so the result is kept on
+    # disk and reused while the IP, driver and orientation stay the same.
+    epd = panel_owner.panel
+    try:
+        with open(SPLASH_CACHE_PATH, "rb") as fh:
+            header = fh.readline().decode("utf-8", "replace").strip()
+            if header == key:
+                return fh.read()
+    except OSError:
+        pass
+    startup = splash_image((epd.width, epd.height), ip)
+    with tracer.span("render splash"):
+        buf = bytes(epd.getbuffer(startup))
+    tmp = SPLASH_CACHE_PATH + ".tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(key.encode("utf-8") + b"\n" + buf)
+    os.replace(tmp, SPLASH_CACHE_PATH)
+    return buf
+
+def show_startup_splash() -> None:
+    # runs in the background while the web server is already answering
+    with tracer.trace("splash", job="splash"):
+        _startup_splash()
+
+def _startup_splash() -> None:
+    global _panel_job
+    ip = get_ip()
+    try:
+        width, height = panel_native_size()
+        driver = "daemon" if display_client is not None else epd7in3e.__name__
+        key = f"splash {driver} {width}x{height} {EPD_ROTATION} {EPD_MIRROR} {ip}"
+        if _read_panel_state() == key:
+            app.logger.info("Panel already shows %s, skipping splash refresh", ip)
+            panel_refreshes.inc(kind="skipped")
+            return
+        if display_client is not None:
+            _splash_via_daemon(splash_image((width, height), ip), key, ip)
+            return
+        buf = splash_buffer(key, ip)
+        startup_timing.mark("IP splash buffer")
+        epd = panel_owner.panel
+        with panel_owner.claim() as session:
+            if _panel_updates:
+                return  # someone sent a picture first; don't paint over it
+            try:
+                _write_panel_state("")
+                _panel_phase("splash", "panel init")
+                session.wake()
+                _panel_phase("splash", "drawing", "splash")
+                epd.display(buf)
+                session.done()
+                _write_panel_state(key)
+                panel_refreshes.inc(kind="full")
+                events.publish("splash", "display", "done", ip=ip)
+            except Exception:
+                session.failed()
+                raise
+            finally:
+                _panel_job = None
+        startup_timing.mark("IP splash on panel")
+    except Exception as exc:
+        app.logger.exception("Startup splash failed")
+        events.publish("splash", "display", "failed", error=str(exc))
+    finally:
+        startup_timing.report()
+
+def _splash_via_daemon(image, key: str, ip: str) -> None:
+    # packing needs the driver, which lives in the daemon, so the splash
+    # goes over as PIXELS like any other picture
+    if _panel_updates:
+        return
+    _write_panel_state("")
+    events.publish("splash", "display", "sending to display daemon")
+    with tracer.span("display daemon"), stage_seconds.time(stage="daemon"):
+        reply = display_client.show_pixels(image)
+    _write_panel_state(key)
+    panel_refreshes.inc(kind="full")
+    events.publish("splash", "display", "done", ip=ip, warm=reply.get("warm", False))
+    startup_timing.mark("IP splash on panel")
 
 def timestamp_prefix() -> str:
     return datetime.now().strftime("%Y%m%d-%H%M%S")
@@ -198,17 +607,138 @@ def subject_from_prompt(prompt: str) -> str:
         return seg
     return cleaned
 
-def ensure_unique_filename(base_name: str) -> str:
-    path = os.path.join(UPLOAD_FOLDER, base_name)
-    if not os.path.exists(path):
-        return base_name
+_name_lock = threading.Lock()
+_name_counters = {}
+
+def reserve_unique_filename(base_name: str) -> str:
+    # Claim the name by creating an empty placeholder with O_EXCL, so two
+    # requests can never end up writing the same file. The per-name counter
+    # hands out the next "_N" suffix directly instead of probing 1, 2, 3...;
+    # O_EXCL still catches files created by other processes.
     name, ext = os.path.splitext(base_name)
-    counter = 1
-    candidate = f"{name}_{counter}{ext}"
-    while os.path.exists(os.path.join(UPLOAD_FOLDER, candidate)):
-        counter += 1
-        candidate = f"{name}_{counter}{ext}"
-    return candidate
+    while True:
+        with _name_lock:
+            counter = _name_counters.get(base_name, 0)
+            if len(_name_counters) > 1024:
+                _name_counters.clear()
+            _name_counters[base_name] = counter + 1
+        candidate = base_name if counter == 0 else f"{name}_{counter}{ext}"
+        try:
+            fd = os.open(
+                os.path.join(UPLOAD_FOLDER, candidate),
+                os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                0o644,
+            )
+        except FileExistsError:
+            continue
+        os.close(fd)
+        return candidate
+
+def release_reserved_filename(name: str) -> None:
+    try:
+        os.remove(os.path.join(UPLOAD_FOLDER, name))
+    except FileNotFoundError:
+        pass
+
+def check_image(path: str) -> None:
+    # The header sniff only proves the format. Decode the stored file so a
+    # truncated or garbage body is refused here rather than failing on the
+    # panel or in the gallery. JPEGs decode at 1/8 scale (draft mode),
+    # which still reads every byte of the entropy-coded data.
+    try:
+        with Image.open(path) as img:
+            img.draft("RGB", (max(img.width // 8, 1), max(img.height // 8, 1)))
+            img.load()
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as exc:
+        raise UnsupportedImage(f"Unreadable image: {exc}") from exc
+
+def store_upload(stream, original_name: str, *, thumbnail=True):
+    # stream an upload into the blob store under a fresh timestamped name;
+    # a re-uploaded image only adds a link and an index row
+    safe_name = secure_filename(original_name or "") or "upload.png"
+    save_name = reserve_unique_filename(f"{timestamp_prefix()}_{safe_name}")
+    path = os.path.join(UPLOAD_FOLDER, save_name)
+    try:
+        digest, size, _ = blob_store.ingest(stream, path, max_bytes=UPLOAD_MAX_BYTES)
+    except Exception:
+        release_reserved_filename(save_name)
+        raise
+    duplicate = bool(upload_index.names_for_hash(digest))
+    if not duplicate:
+        # the same bytes under another name were already checked
+        try:
+            check_image(path)
+        except UnsupportedImage:
+            release_reserved_filename(save_name)
+            blob_store.release(digest)
+            raise
+    entry = upload_index.add(save_name, "upload", size=size, sha256=digest)
+    if thumbnail:
+        thumbnails.schedule(save_name, digest)
+    retention.trigger()
+    return entry, duplicate
+
+def remove_upload(filename: str) -> None:
+    # delete one name plus everything derived from it; shared artifacts
+    # (blob, thumbnail) go with the last name that references them, even
+    # when that file had already vanished from disk
+    path = resolve_upload_path(filename)
+    entry = upload_index.get(filename)
+    try:
+        os.remove(path)
+        missing = False
+    except FileNotFoundError:
+        missing = True
+    upload_index.remove(filename)
+    digest = entry["sha256"] if entry else None
+    if digest and not upload_index.names_for_hash(digest):
+        blob_store.release(digest)
+        thumbnails.discard(digest)
+    elif not digest:
+        thumbnails.discard(filename)
+    with _etag_lock:
+        _etag_cache.pop(path, None)
+    if missing:
+        raise FileNotFoundError(filename)
+
+def adopt_legacy_uploads():
+    # hash files indexed from disk (pre-store or copied in by hand) and fold
+    # duplicates into shared blobs; runs once in the background at startup
+    while True:
+        names = upload_index.unhashed()
+        if not names:
+            return
+        for name in names:
+            path = os.path.join(UPLOAD_FOLDER, name)
+            try:
+                digest, _ = blob_store.adopt(path)
+            except FileNotFoundError:
+                upload_index.remove(name)
+                continue
+            except OSError:
+                app.logger.exception("Unable to adopt %s into the blob store", name)
+                return
+            upload_index.set_hash(name, digest)
+
+_etag_lock = threading.Lock()
+_etag_cache = {}
+
+def upload_etag(path: str) -> str:
+    # content hash, remembered until the file is replaced or rewritten
+    stat = os.stat(path)
+    key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with _etag_lock:
+        cached = _etag_cache.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(chunk)
+    etag = digest.hexdigest()[:32]
+    with _etag_lock:
+        _etag_cache[path] = (key, etag)
+    return etag
 
 def resolve_upload_path(filename: str) -> str:
     if not filename:
@@ -219,62 +749,295 @@ def resolve_upload_path(filename: str) -> str:
         raise ValueError("Invalid path")
     return target
 
+retention = RetentionPolicy(
+    upload_index,
+    remove_upload,
+    max_bytes=_int_env("RETAIN_MAX_MB", 0) * 1024 * 1024,
+    max_count=_int_env("RETAIN_MAX_COUNT", 0),
+    max_age=_int_env("RETAIN_MAX_DAYS", 0) * 24 * 3600,
+    interval=_int_env("RETAIN_INTERVAL_MIN", 60) * 60,
+)
+
+BACKGROUND_LOCK_FILE = os.path.join(DATA_FOLDER, "background.lock")
+BACKGROUND_RETRY_SEC = 60
+_background_lock = threading.Lock()
+_background_pid = None
+_background_fd = None       # flock'd BACKGROUND_LOCK_FILE while this process runs them
+_background_tried = 0.0
+
+def start_background_services() -> None:
+    # One process of the app runs the adopt and retention threads, in a
+    # process that serves requests: under gunicorn --preload this module is
+    # imported in the master, and threads started there are not carried
+    # into the forked workers. The other workers retry the lock file now
+    # and then and take over if the owner exits.
+    global _background_pid, _background_fd, _background_tried
+    with _background_lock:
+        if _background_pid == os.getpid():
+            return
+        now = time.monotonic()
+        if _background_tried and now - _background_tried < BACKGROUND_RETRY_SEC:
+            return
+        _background_tried = now
+        fd = os.open(BACKGROUND_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return
+        _background_fd = fd
+        _background_pid = os.getpid()
+    threading.Thread(target=adopt_legacy_uploads, name="adopt-uploads", daemon=True).start()
+    retention.start()
+
+def _background_after_fork() -> None:
+    # a forked child doesn't run the parent's threads; it must not keep the
+    # parent's lock file open either, or the lock outlives the parent
+    global _background_fd, _background_tried, _background_lock
+    if _background_fd is not None:
+        os.close(_background_fd)
+        _background_fd = None
+    _background_tried = 0.0
+    _background_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_background_after_fork)
+
+@app.before_request
+def _ensure_background_services():
+    start_background_services()
+
 # ---------------------------------------------------------------------------
 # routes
 # ---------------------------------------------------------------------------
 
+def _display_failed(job, message: str, code: int):
+    # an update that stops before send_to_display() still ends its /events
+    # stream, so the page doesn't wait on "decoding" forever
+    events.publish(job, "display", "failed", error=message)
+    return message, code
+
 @app.route("/", methods=["GET", "POST"])
+@profiled("display")
 def index():
     if request.method == "POST":
         file = request.files.get("image")
         if not file:
             return "No file uploaded", 400
+        # the page may pick its own id so it can follow the job on /events
+        job = request.form.get("job_id", "")
+        if not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", job):
+            job = uuid.uuid4().hex
+        events.publish(job, "display", "decoding")
 
-        # --------- overlay options (backend only if requested) ---------
-        overlay    = request.form.get("show_overlay") == "on"
-        ol_x       = int(request.form.get("overlay_x", 10))
-        ol_y       = int(request.form.get("overlay_y", 10))
-        ol_size    = int(request.form.get("overlay_font_size", 18))
-        ol_color_h = request.form.get("overlay_font_color", "#000000")
-        ol_text    = request.form.get("overlay_text", "")
-        r, g, b    = (int(ol_color_h[i : i + 2], 16) for i in (1, 3, 5))
-
-        # canvas snapshot vs. user upload (keep both on disk)
-        if file.filename == "processed.png":
-            src_img = Image.open(BytesIO(file.read())).convert("RGB")
-        else:
-            safe_name = secure_filename(file.filename) or "upload.png"
-            save_name = ensure_unique_filename(f"{timestamp_prefix()}_{safe_name}")
-            path = os.path.join(UPLOAD_FOLDER, save_name)
-            file.save(path)
-            src_img = Image.open(path).convert("RGB")
-
-        # nothing else to process - client already handled it
-        send_to_display(
-            src_img,
-            overlay=overlay,
-            pos=(ol_x, ol_y),
-            fsize=ol_size,
-            fcolor=(r, g, b),
-            text=ol_text,
-        )
+        with tracer.trace("display", job=job, file=file.filename):
+            # --------- overlay options (backend only if requested) ---------
+            overlay    = request.form.get("show_overlay") == "on"
+            ol_color_h = request.form.get("overlay_font_color", "#000000")
+            ol_text    = request.form.get("overlay_text", "")
+            try:
+                ol_x       = int(request.form.get("overlay_x", 10))
+                ol_y       = int(request.form.get("overlay_y", 10))
+                ol_size    = int(request.form.get("overlay_font_size", 18))
+                r, g, b    = (int(ol_color_h[i : i + 2], 16) for i in (1, 3, 5))
+            except ValueError as exc:
+                return _display_failed(job, f"Invalid overlay settings: {exc}", 400)
+
+            # canvas snapshot vs. user upload (keep both on disk)
+            if file.filename == "processed.png":
+                # decode straight from Werkzeug's spooled file, no extra copy
+                try:
+                    with pipeline_stage("decode"):
+                        src_img = Image.open(file.stream).convert("RGB")
+                except (OSError, Image.DecompressionBombError):
+                    return _display_failed(job, "Not a supported image file", 415)
+                shown = request.form.get("source_filename", "").strip()
+            else:
+                try:
+                    with tracer.span("store upload"):
+                        entry, _ = store_upload(file.stream, file.filename)
+                except UploadTooLarge as exc:
+                    return _display_failed(job, str(exc), 413)
+                except UnsupportedImage as exc:
+                    return _display_failed(job, str(exc), 415)
+                shown = entry["filename"]
+                path = os.path.join(UPLOAD_FOLDER, shown)
+                with pipeline_stage("decode"):
+                    src_img = Image.open(path).convert("RGB")
+
+            # nothing else to process - client already handled it
+            try:
+                send_to_display(
+                    src_img,
+                    overlay=overlay,
+                    pos=(ol_x, ol_y),
+                    fsize=ol_size,
+                    fcolor=(r, g, b),
+                    text=ol_text,
+                    job=job,
+                )
+            except (PanelBusy, DisplayDaemonError) as exc:
+                return str(exc), 503
+            if shown:
+                # retention evicts least-recently-displayed images first
+                upload_index.mark_displayed(shown)
         return "Image sent to e-Paper display successfully! <a href='/'>Back</a>"
 
-    return render_template("index.html")
+    # the preview canvas (and so processed.png) has the panel's logical size
+    return render_template("index.html", prompt_presets=PROMPT_PRESETS,
+                           panel_size=PANEL_SIZE, panel_shape=PANEL_SHAPE)
 
 @app.route("/upload_file", methods=["POST"])
 def upload_file():
-    file = request.files.get("image")
-    if not file or not file.filename:
-        return jsonify({"error": "No file provided"}), 400
-    safe_name = secure_filename(file.filename) or "upload.png"
-    save_name = ensure_unique_filename(f"{timestamp_prefix()}_{safe_name}")
-    path = os.path.join(UPLOAD_FOLDER, save_name)
+    # A raw image body (Content-Type: image/*, name in ?filename=) is read
+    # straight off the socket; multipart forms go through Werkzeug's spool.
+    if request.mimetype.startswith("image/"):
+        stream, original_name = request.stream, request.args.get("filename", "")
+    else:
+        file = request.files.get("image")
+        if not file or not file.filename:
+            return jsonify({"error": "No file provided"}), 400
+        stream, original_name = file.stream, file.filename
     try:
-        file.save(path)
+        entry, duplicate = store_upload(stream, original_name)
+    except UploadTooLarge as exc:
+        return jsonify({"error": str(exc)}), 413
+    except UnsupportedImage as exc:
+        return jsonify({"error": str(exc)}), 415
     except OSError as exc:
         return jsonify({"error": f"Unable to save file: {exc}"}), 500
-    return jsonify({"filename": save_name})
+    return jsonify({"filename": entry["filename"], "duplicate": duplicate})
+
+def fallback_models(model_id: str) -> list:
+    # the requested model first, then the rest of MODEL_CHOICES in order
+    ids = [entry["id"] for entry in MODEL_CHOICES]
+    if not HF_FALLBACK or model_id not in ids:
+        return [model_id]
+    start = ids.index(model_id)
+    return ids[start:] + ids[:start]
+
+def run_generation(job):
+    # worker-thread body of a generation job; returns {"filename": ...}
+    with tracer.trace("generate", job=job.id, model=job.model):
+        if not job.params.get("profile"):
+            return _run_generation(job)
+        result, name = profiles.run("generate", _run_generation, job)
+        if name:
+            result["profile"] = name
+        return result
+
+def _run_generation(job):
+    params = job.params
+
+    def attempt(model_id):
+        width, height = generation_size(model_id)
+        options = {
+            "model": f"{HF_BASE_URL}/models/{model_id}" if HF_BASE_URL else model_id,
+            "width": width,
+            "height": height,
+        }
+        if params.get("seed") is not None:
+            options["seed"] = params["seed"]
+        began = time.perf_counter()
+        outcome = "error"
+        try:
+            with tracer.span("inference", model=model_id):
+                result = get_client().text_to_image(params["prompt"], **options)
+            outcome = "ok"
+            return result
+        finally:
+            generation_seconds.observe(
+                time.perf_counter() - began, model=model_id, outcome=outcome)
+
+    generated, model_used = inference.call(
+        fallback_models(job.model), attempt,
+        switch=lambda model_id: generation.use_model(job, model_id))
+    if isinstance(generated, bytes):
+        img = Image.open(BytesIO(generated))
+    else:
+        img = generated
+    name_parts = [timestamp_prefix()]
+    if params["subject"]:
+        name_parts.append(params["subject"])
+    if params["preset"]:
+        name_parts.append(params["preset"])
+    base_name = "-".join(name_parts) + GEN_STORAGE.ext
+    fname = reserve_unique_filename(base_name)
+    path = os.path.join(UPLOAD_FOLDER, fname)
+    try:
+        with tracer.span("save"):
+            GEN_STORAGE.save(img, path)
+        with tracer.span("blob store"):
+            digest, size = blob_store.adopt(path)
+    except Exception:
+        release_reserved_filename(fname)
+        raise
+    upload_index.add(
+        fname,
+        "generated",
+        model=model_used,
+        preset=params["preset"] or None,
+        subject=params["subject"] or None,
+        size=size,
+        sha256=digest,
+    )
+    thumbnails.schedule(fname, digest)
+    retention.trigger()
+    if model_used == job.model:
+        # a fallback result doesn't answer the cached (prompt, model) question
+        generation_cache.store(params["cache_key"], fname)
+    return {"filename": fname, "model": model_used, "fallback": model_used != job.model}
+
+def publish_generation(job):
+    # GenerationService listener: job status changes -> /events
+    stage = {RUNNING: "generating"}.get(job.status, job.status)
+    data = {"model": job.model}
+    if job.result:
+        data.update(job.result)
+    if job.error:
+        data["error"] = job.error
+    events.publish(job.id, "generate", stage, **data)
+
+generation_cache = GenerationCache(os.path.join(DATA_FOLDER, "generation.db"))
+generation = GenerationService(
+    run_generation,
+    workers=_int_env("GEN_WORKERS", 2),
+    per_model=_int_env("GEN_PER_MODEL", 1),
+    listener=publish_generation,
+    store=JobStore(os.path.join(DATA_FOLDER, "generation.db")),
+)
+
+def generation_size(model_id: str):
+    # (width, height) to request from model_id: the configured size scaled up
+    # so the short side reaches GEN_MIN_SIDE, then rounded to the model's
+    # multiple. Keeps the aspect ratio (and orientation) of the panel.
+    width, height = max(1, GEN_WIDTH), max(1, GEN_HEIGHT)
+    scale = max(1.0, GEN_MIN_SIDE / min(width, height))
+    multiple = MODEL_SIZE_MULTIPLE.get(model_id, 8)
+    return tuple(
+        max(multiple, int(round(side * scale / multiple)) * multiple)
+        for side in (width, height)
+    )
+
+def queue_generation(prompt, model_id, *, subject, preset, seed=None, force=False,
+                     profile=False):
+    # returns (cached filename, None) on a cache hit, else (None, job)
+    cache_key = GenerationCache.make_key(
+        cleaned_prompt_text(prompt), model_id, *generation_size(model_id), seed
+    )
+    cached = generation_cache.lookup(cache_key, force=force)
+    if cached:
+        if upload_index.get(cached):
+            return cached, None
+        generation_cache.forget(cache_key)  # result was deleted since
+    job = generation.submit(model_id, {
+        "prompt": prompt,
+        "subject": prompt_slug(subject, fallback=""),
+        "preset": prompt_slug(preset, fallback=""),
+        "seed": seed,
+        "cache_key": cache_key,
+        "profile": profile,
+    })
+    return None, job
 
 @app.route("/generate", methods=["POST"])
 def generate():
@@ -282,42 +1045,269 @@ def generate():
     preset_name = request.form.get("preset_name", "custom")
     subject_name = request.form.get("subject_name", "")
     subject_source = subject_name or subject_from_prompt(prompt_input)
-    slug_subject = prompt_slug(subject_source, fallback="")
-    slug_preset = prompt_slug(preset_name, fallback="")
-    prompt = prompt_input
     selected_model = request.form.get("model") or HF_MODEL
     model_id = selected_model if selected_model in MODEL_ID_LOOKUP else HF_MODEL
+    cached, job = queue_generation(
+        prompt_input,
+        model_id,
+        subject=subject_source,
+        preset=preset_name,
+        seed=request.form.get("seed", type=int),
+        force=request.form.get("force") in ("1", "true", "on"),
+        # the request itself only queues; the job is what gets profiled
+        profile=profiling_requested(),
+    )
+    if cached:
+        return jsonify({"filename": cached, "cached": True})
+    return jsonify({"job_id": job.id, "status": job.status}), 202
+
+def batch_variants(payload):
+    # Expand a batch request into (prompt, subject, preset, seed) tuples:
+    # either an explicit "prompts" list, or one "prompt" crossed with
+    # "presets" (chip names, or "all") and "seeds" (or "count" random seeds).
+    prompts = payload.get("prompts")
+    if prompts:
+        if not isinstance(prompts, list) or not all(isinstance(p, str) and p.strip() for p in prompts):
+            raise ValueError("prompts must be a list of non-empty strings")
+        return [(p, subject_from_prompt(p), "custom", None) for p in prompts]
+    prompt = payload.get("prompt")
+    if not isinstance(prompt, str) or not prompt.strip():
+        raise ValueError("Provide prompts or a prompt")
+    subject = payload.get("subject") or subject_from_prompt(prompt)
+    presets = payload.get("presets") or []
+    if presets == "all":
+        presets = list(PROMPT_PRESETS)
+    if not isinstance(presets, list):
+        raise ValueError("presets must be a list or \"all\"")
+    unknown = [p for p in presets if p not in PROMPT_PRESETS]
+    if unknown:
+        raise ValueError(f"Unknown presets: {', '.join(map(str, unknown))}")
+    seeds = payload.get("seeds")
+    if seeds is None:
+        count = payload.get("count", 1)
+        if not isinstance(count, int) or count < 1:
+            raise ValueError("count must be a positive integer")
+        if count > GEN_BATCH_MAX:
+            raise ValueError(f"Batch limited to {GEN_BATCH_MAX} images")
+        seeds = [None] if count == 1 else [random.randrange(2**31) for _ in range(count)]
+    elif not isinstance(seeds, list) or not all(isinstance(x, int) for x in seeds):
+        raise ValueError("seeds must be a list of integers")
+    variants = []
+    for preset in presets or [None]:
+        text = PROMPT_PRESETS[preset].replace("{SUBJECT}", subject) if preset else prompt
+        for seed in seeds:
+            variants.append((text, subject, preset or payload.get("preset_name") or "custom", seed))
+    return variants
+
+@app.route("/generate_batch", methods=["POST"])
+def generate_batch():
+    payload = request.get_json(silent=True) or {}
     try:
-        generated = client.text_to_image(
-            prompt,
-            model=model_id,
-            width=GEN_WIDTH,
-            height=GEN_HEIGHT,
+        variants = batch_variants(payload)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    if len(variants) > GEN_BATCH_MAX:
+        return jsonify({"error": f"Batch limited to {GEN_BATCH_MAX} images"}), 400
+    models = payload.get("models") or [payload.get("model") or HF_MODEL]
+    if models == "all":
+        models = [choice["id"] for choice in MODEL_CHOICES]
+    if not isinstance(models, list) or not all(m in MODEL_ID_LOOKUP for m in models):
+        return jsonify({"error": "Unknown model"}), 400
+    force = bool(payload.get("force"))
+
+    # queue everything up front so the pool works on the batch concurrently;
+    # models are assigned round-robin, each under its own concurrency cap
+    results, jobs = [], {}
+    for number, (prompt, subject, preset, seed) in enumerate(variants):
+        model_id = models[number % len(models)]
+        cached, job = queue_generation(
+            prompt, model_id, subject=subject, preset=preset, seed=seed, force=force
         )
-        if isinstance(generated, bytes):
-            img = Image.open(BytesIO(generated))
+        item = {"index": number, "model": model_id, "preset": preset, "seed": seed}
+        if cached:
+            results.append(dict(item, status="done", filename=cached, cached=True))
         else:
-            img = generated
-        name_parts = [timestamp_prefix()]
-        if slug_subject:
-            name_parts.append(slug_subject)
-        if slug_preset:
-            name_parts.append(slug_preset)
-        base_name = "-".join(name_parts) + ".png"
-        fname = ensure_unique_filename(base_name)
-        img.save(os.path.join(UPLOAD_FOLDER, fname))
-        return jsonify({"filename": fname})
-    except Exception as e:
-        app.logger.exception("Image generation failed")
-        return jsonify({"error": str(e)}), 500
+            jobs[job.id] = (job, item)
+
+    def stream():
+        # one JSON object per line, in completion order
+        yield json.dumps({"total": len(variants), "queued": len(jobs)}) + "\n"
+        for item in results:
+            yield json.dumps(item) + "\n"
+        for job in generation.as_completed([job for job, _ in jobs.values()]):
+            item = dict(jobs[job.id][1], job_id=job.id, status=job.status)
+            if job.result:
+                item["filename"] = job.result["filename"]
+            if job.error:
+                item["error"] = job.error
+            yield json.dumps(item) + "\n"
+
+    return Response(stream(), mimetype="application/x-ndjson")
+
+@app.route("/events")
+def event_stream():
+    # Server-Sent Events: one "job" event per stage change; resumes after
+    # Last-Event-ID, otherwise starts with a snapshot of jobs in flight
+    try:
+        last_id = int(request.headers.get("Last-Event-ID") or request.args.get("since") or -1)
+    except ValueError:
+        last_id = -1
+    if not _event_clients.acquire(blocking=False):
+        response = jsonify({"error": f"Too many event streams open (at most {EVENTS_MAX_CLIENTS})"})
+        response.status_code = 503
+        response.headers["Retry-After"] = "30"
+        return response
+
+    def stream():
+        since = last_id
+        yield "retry: 3000\n\n"
+        # an id from before a restart is ahead of the new counter: start over
+        if since < 0 or since > events.last_id():
+            since = events.last_id()
+            yield f"event: snapshot\ndata: {json.dumps(events.active())}\n\n"
+        for event in events.stream(since):
+            if event is None:
+                yield ": keepalive\n\n"
+                continue
+            yield f"id: {event['id']}\nevent: job\ndata: {json.dumps(event)}\n\n"
+
+    response = Response(stream(), mimetype="text/event-stream")
+    response.call_on_close(_event_clients.release)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"   # don't let a proxy buffer it
+    return response
+
+def _cache_lookups():
+    stats = generation_cache.stats()
+    return [
+        ({"result": "hit"}, stats["hits"]),
+        ({"result": "miss"}, stats["misses"]),
+        ({"result": "forced"}, stats["forced"]),
+    ]
+
+metrics.gauge("epaper_generation_queue_depth", "Generation jobs waiting for a worker",
+              lambda: generation.queue_depth())
+metrics.gauge("epaper_generation_running", "Generation jobs currently running",
+              lambda: generation.running())
+metrics.gauge("epaper_generation_cache_lookups_total", "Generation cache lookups by result",
+              _cache_lookups, kind="counter")
+metrics.gauge("epaper_model_circuit_open", "1 while a model's circuit breaker is not closed",
+              lambda: [({"model": model}, int(state != "closed"))
+                       for model, state in inference.states().items()])
+metrics.gauge("epaper_panel_busy", "1 while a display update holds the panel",
+              lambda: int(panel_owner.busy()))
+
+@app.route("/traces")
+def list_traces():
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 500)
+    return jsonify({
+        "traces": tracer.recent(
+            kind=request.args.get("kind") or None,
+            slow_only=request.args.get("slow") in ("1", "true"),
+            limit=limit,
+        ),
+        "slow_thresholds": tracer.slow,
+    })
+
+@app.route("/traces/<trace_id>")
+def get_trace(trace_id):
+    trace = tracer.get(trace_id)
+    if trace is None:
+        return jsonify({"error": "Unknown trace"}), 404
+    return jsonify(trace)
+
+@app.route("/profiles")
+def list_profiles():
+    return jsonify({"profiles": profiles.list(), "mode": PROFILE_MODE})
+
+@app.route("/profiles/<name>")
+def get_profile(name):
+    # text summary by default; ?format=prof for the raw pstats dump
+    raw = request.args.get("format") == "prof"
+    try:
+        path = profiles.path_for(name, ".prof" if raw else ".txt")
+    except ValueError:
+        return jsonify({"error": "Invalid profile name"}), 400
+    if not os.path.exists(path):
+        return jsonify({"error": "Profile not found"}), 404
+    if raw:
+        return send_file(path, mimetype="application/octet-stream",
+                         as_attachment=True, download_name=name + ".prof")
+    return send_file(path, mimetype="text/plain")
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/generation_cache")
+def generation_cache_stats():
+    return jsonify(generation_cache.stats())
+
+@app.route("/generate/<job_id>")
+def generation_status(job_id):
+    job = generation.status(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job)
 
 @app.route("/uploads/<filename>")
 def serve_upload(filename):
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    try:
+        path = resolve_upload_path(filename)
+    except ValueError:
+        return jsonify({"error": "Invalid filename"}), 400
+    if not os.path.isfile(path):
+        return jsonify({"error": "File not found"}), 404
+    # conditional=True gives us If-None-Match -> 304 and Range -> 206
+    entry = upload_index.get(filename)
+    etag = entry["sha256"][:32] if entry and entry["sha256"] else upload_etag(path)
+    response = send_file(
+        path,
+        etag=etag,
+        conditional=True,
+        max_age=UPLOAD_MAX_AGE,
+    )
+    response.cache_control.immutable = True
+    return response
+
+@app.route("/thumbs/<filename>")
+def serve_thumbnail(filename):
+    try:
+        path = resolve_upload_path(filename)
+    except ValueError:
+        return jsonify({"error": "Invalid filename"}), 400
+    if not os.path.exists(path):
+        return jsonify({"error": "File not found"}), 404
+    entry = upload_index.get(filename)
+    try:
+        thumb = thumbnails.ensure(filename, entry["sha256"] if entry else None)
+    except (OSError, Image.DecompressionBombError) as exc:
+        return jsonify({"error": f"Unable to create thumbnail: {exc}"}), 415
+    return send_file(
+        thumb,
+        mimetype=thumbnails.mimetype,
+        etag=thumbnails.etag(thumb),
+        conditional=True,
+        max_age=3600,
+    )
 
 @app.route("/list_uploads")
 def list_uploads():
-    return jsonify(sorted(os.listdir(UPLOAD_FOLDER), reverse=True))
+    # ?since=<seq> returns only what changed; otherwise a page of entries
+    since = request.args.get("since", type=int)
+    if since is not None:
+        return jsonify(upload_index.changes_since(since))
+    source = request.args.get("source") or None
+    if source and source not in SOURCES:
+        return jsonify({"error": f"Unknown source {source}"}), 400
+    limit = max(1, min(request.args.get("limit", 100, type=int), 500))
+    return jsonify(upload_index.page(
+        limit=limit,
+        cursor=request.args.get("cursor") or None,
+        source=source,
+        model=request.args.get("model") or None,
+        preset=request.args.get("preset") or None,
+    ))
 
 @app.route("/delete_upload", methods=["POST"])
 def delete_upload():
@@ -326,31 +1316,202 @@ def delete_upload():
     if not filename:
         return jsonify({"error": "Filename required"}), 400
     try:
-        path = resolve_upload_path(filename)
+        remove_upload(filename)
     except ValueError:
         return jsonify({"error": "Invalid filename"}), 400
-    if not os.path.exists(path):
+    except FileNotFoundError:
         return jsonify({"error": "File not found"}), 404
-    try:
-        os.remove(path)
     except OSError as exc:
         return jsonify({"error": f"Unable to delete file: {exc}"}), 500
     return jsonify({"success": True})
 
+@app.route("/delete_uploads", methods=["POST"])
+def delete_uploads():
+    payload = request.get_json(silent=True) or {}
+    filenames = payload.get("filenames")
+    if not isinstance(filenames, list) or not filenames:
+        return jsonify({"error": "filenames must be a non-empty list"}), 400
+    if len(filenames) > BULK_MAX_FILES:
+        return jsonify({"error": f"At most {BULK_MAX_FILES} files per request"}), 400
+    deleted, errors = [], {}
+    for filename in filenames:
+        filename = str(filename).strip()
+        try:
+            remove_upload(filename)
+        except ValueError:
+            errors[filename] = "Invalid filename"
+        except FileNotFoundError:
+            errors[filename] = "File not found"
+        except OSError as exc:
+            errors[filename] = f"Unable to delete file: {exc}"
+        else:
+            deleted.append(filename)
+    return jsonify({"deleted": deleted, "errors": errors})
+
+@app.route("/import_archive", methods=["POST"])
+def import_archive():
+    # Archives can be far larger than a single upload (Flask >= 3.1).
+    request.max_content_length = IMPORT_MAX_BYTES
+    if request.mimetype.startswith("multipart/"):
+        file = request.files.get("archive")
+        if not file or not file.filename:
+            return jsonify({"error": "No archive provided"}), 400
+        kind = archives.archive_kind(file.mimetype, file.filename)
+        stream = file.stream        # already spooled by Werkzeug
+    else:
+        # raw body, named by its Content-Type or ?filename=
+        kind = archives.archive_kind(request.mimetype, request.args.get("filename", ""))
+        stream = request.stream
+        if kind == "zip":
+            # zip needs its central directory, so spool the body first
+            stream = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+            for chunk in iter(lambda: request.stream.read(256 * 1024), b""):
+                stream.write(chunk)
+            stream.seek(0)
+    if kind is None:
+        return jsonify({"error": "Not a ZIP or TAR archive"}), 400
+    if kind == "zip":
+        members = archives.iter_zip_images(stream)
+    else:
+        members = archives.iter_tar_images(stream)
+
+    imported, skipped, pending_thumbs = [], {}, []
+    duplicates = 0
+    try:
+        for name, member in members:
+            try:
+                entry, duplicate = store_upload(member, name, thumbnail=False)
+            except (UploadTooLarge, UnsupportedImage) as exc:
+                skipped[name] = str(exc)
+                continue
+            imported.append(entry["filename"])
+            duplicates += int(duplicate)
+            pending_thumbs.append((entry["filename"], entry["sha256"]))
+    except (zipfile.BadZipFile, tarfile.TarError) as exc:
+        if not imported:
+            return jsonify({"error": f"Unreadable archive: {exc}"}), 400
+        skipped["(archive)"] = f"Stopped early: {exc}"
+    thumbnails.schedule_batch(pending_thumbs)
+    return jsonify({"imported": imported, "duplicates": duplicates, "skipped": skipped})
+
+@app.route("/export_archive", methods=["POST"])
+def export_archive():
+    # JSON {"filenames": [...], "format": ...} from scripts; the UI posts a
+    # form (so the browser streams the download) whose `filenames` field
+    # holds the same list as JSON. A name per query parameter would overrun
+    # request-line limits long before BULK_MAX_FILES.
+    if request.is_json:
+        payload = request.get_json(silent=True) or {}
+        names = payload.get("filenames")
+    else:
+        payload = request.form
+        try:
+            names = json.loads(request.form.get("filenames") or "null")
+        except ValueError:
+            names = None
+    fmt = payload.get("format") or "zip"
+    if fmt not in ("zip", "tar"):
+        return jsonify({"error": "format must be zip or tar"}), 400
+    if not isinstance(names, list) or not names:
+        return jsonify({"error": "filenames must be a non-empty list"}), 400
+    if len(names) > BULK_MAX_FILES:
+        return jsonify({"error": f"At most {BULK_MAX_FILES} files per request"}), 400
+    files = []
+    for name in map(str, names):
+        try:
+            path = resolve_upload_path(name)
+        except ValueError:
+            return jsonify({"error": f"Invalid filename {name}"}), 400
+        if not os.path.isfile(path):
+            return jsonify({"error": f"File not found: {name}"}), 404
+        files.append((name, path))
+    stream = archives.stream_zip(files) if fmt == "zip" else archives.stream_tar(files)
+    download = f"epaper-export-{timestamp_prefix()}.{fmt}"
+    return Response(
+        stream,
+        mimetype="application/zip" if fmt == "zip" else "application/x-tar",
+        headers={"Content-Disposition": f"attachment; filename={download}"},
+    )
+
+@app.route("/pin_upload", methods=["POST"])
+def pin_upload():
+    payload = request.get_json(silent=True) or {}
+    filename = (payload.get("filename") or "").strip()
+    if not filename:
+        return jsonify({"error": "Filename required"}), 400
+    pinned = bool(payload.get("pinned", True))
+    if not upload_index.set_pinned(filename, pinned):
+        return jsonify({"error": "File not found"}), 404
+    return jsonify({"success": True, "pinned": pinned})
+
 @app.route("/hf_models")
 def hf_models():
-    return jsonify({"models": MODEL_CHOICES, "default": HF_MODEL})
+    models = [
+        dict(
+            entry,
+            size=list(generation_size(entry["id"])),
+            circuit=inference.breaker(entry["id"]).state,
+        )
+        for entry in MODEL_CHOICES
+    ]
+    return jsonify({"models": models, "default": HF_MODEL, "panel_size": list(PANEL_SIZE)})
+
+def panel_palette_colors():
+    # the driver's PALETTE; with a display daemon, as the daemon reports it
+    if display_client is not None:
+        return display_client.panel_palette()
+    if epd7in3e is None:
+        raise RuntimeError(f"Panel driver unavailable: {EPD_IMPORT_ERROR}")
+    return epd7in3e.EPD.PALETTE
+
+@app.route("/panel_palette")
+def panel_palette():
+    try:
+        codes = panel_palette_colors()
+    except (RuntimeError, PanelBusy, DisplayDaemonError) as exc:
+        return jsonify({"error": str(exc)}), 503
+    colors = [
+        {"code": code, "hex": "#%02x%02x%02x" % rgb}
+        for code, rgb in enumerate(codes)
+        if rgb is not None      # codes this panel doesn't use
+    ]
+    return jsonify({"colors": colors})
+
+@app.route("/panel_preview/<filename>")
+def panel_preview(filename):
+    try:
+        codes = panel_palette_colors()
+        native = (panel_native_size() if display_client is not None
+                  else (epd7in3e.EPD_WIDTH, epd7in3e.EPD_HEIGHT))
+    except (RuntimeError, PanelBusy, DisplayDaemonError) as exc:
+        return jsonify({"error": str(exc)}), 503
+    try:
+        path = resolve_upload_path(filename)
+    except ValueError:
+        return jsonify({"error": "Invalid filename"}), 400
+    if not os.path.exists(path):
+        return jsonify({"error": "File not found"}), 404
+    # same resize + palette mapping the panel applies, without touching SPI
+    size = orientation.logical_size(*native, EPD_ROTATION)
+    with Image.open(path) as src:
+        img = src.resize(size)
+    pal_image = (epd7in3e.EPD.PALETTE_IMAGE if display_client is None
+                 else palette.palette_image(codes))
+    preview = palette.quantize(img, pal_image).convert("RGB")
+    out = BytesIO()
+    preview.save(out, "PNG")
+    out.seek(0)
+    return send_file(out, mimetype="image/png")
+
+startup_timing.mark("background services and routes")
+startup_timing.report()
 
 # ---------------------------------------------------------------------------
 # main
 # ---------------------------------------------------------------------------
 
 if __name__ == "__main__":
-    epd = epd7in3e.EPD()
-    epd.init()
-
-    startup = Image.new("RGB", (epd.width, epd.height), (255, 255, 255))
-    draw_ip_overlay(startup, f"IP: {get_ip()}", "top-left", 24, (0, 0, 0))
-    epd.display(epd.getbuffer(startup))
-
+    start_background_services()
+    # the splash takes a full panel refresh; serve requests meanwhile
+    threading.Thread(target=show_startup_splash, name="splash", daemon=True).start()
     app.run(host="0.0.0.0", port=5000, debug=False)
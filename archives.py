@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Streaming ZIP/TAR helpers for bulk import and export of the library.
+
+Imports read members one at a time so each can be streamed straight into
+the blob store; TAR (optionally gzip/bz2/xz compressed) is read sequentially
+off the request body, ZIP needs its central directory and therefore a
+seekable (spooled) file. Exports are produced as generators so Flask can
+send the archive while it is being written, without building it in memory.
+"""
+
+import io, os, tarfile, zipfile
+
+CHUNK_SIZE = 256 * 1024
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".tif", ".tiff"}
+# what an import may be, by content type or file name
+ZIP_TYPES = {"application/zip", "application/x-zip-compressed"}
+TAR_TYPES = {
+    "application/x-tar", "application/x-gtar", "application/gzip", "application/x-gzip",
+    "application/x-compressed-tar", "application/x-bzip2", "application/x-xz",
+}
+ZIP_EXTENSIONS = (".zip",)
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+
+def archive_kind(mimetype: str = "", filename: str = ""):
+    # "zip", "tar" or None; the file name wins, since browsers often send
+    # archives as application/octet-stream
+    name = (filename or "").lower()
+    if name.endswith(ZIP_EXTENSIONS):
+        return "zip"
+    if name.endswith(TAR_EXTENSIONS):
+        return "tar"
+    if mimetype in ZIP_TYPES:
+        return "zip"
+    if mimetype in TAR_TYPES:
+        return "tar"
+    return None
+
+
+def is_image_name(name: str) -> bool:
+    base = os.path.basename(name)
+    if not base or base.startswith("."):
+        return False  # directories, dotfiles, macOS "._" resource forks
+    return os.path.splitext(base)[1].lower() in IMAGE_EXTENSIONS
+
+
+def iter_zip_images(fileobj):
+    # yields (basename, readable stream) for every image member
+    with zipfile.ZipFile(fileobj) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not is_image_name(info.filename):
+                continue
+            with archive.open(info) as member:
+                yield os.path.basename(info.filename), member
+
+
+def iter_tar_images(fileobj):
+    # "r|*" reads the stream sequentially and sniffs the compression
+    with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+        for info in archive:
+            if not info.isfile() or not is_image_name(info.name):
+                continue
+            member = archive.extractfile(info)
+            if member is None:
+                continue
+            yield os.path.basename(info.name), member
+
+
+class _Pipe(io.RawIOBase):
+    # write-only sink the archive writers fill and the generator drains
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _copy_chunks(path, dest, pipe):
+    with open(path, "rb") as src:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            dest.write(chunk)
+            data = pipe.drain()
+            if data:
+                yield data
+
+
+def stream_zip(files):
+    # files: iterable of (arcname, path). Images are already compressed, so
+    # members are stored as-is; that also keeps the Pi's CPU out of it.
+    pipe = _Pipe()
+    with zipfile.ZipFile(pipe, "w", zipfile.ZIP_STORED) as archive:
+        for arcname, path in files:
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            info.compress_type = zipfile.ZIP_STORED
+            with archive.open(info, "w") as dest:
+                yield from _copy_chunks(path, dest, pipe)
+            data = pipe.drain()
+            if data:
+                yield data
+    yield pipe.drain()
+
+
+def stream_tar(files):
+    # ustar/pax headers written by hand so each member can be streamed in
+    # chunks; TarFile.addfile() wants the whole member in one call
+    offset = 0
+    for arcname, path in files:
+        stat = os.stat(path)
+        info = tarfile.TarInfo(arcname)
+        info.size = stat.st_size
+        info.mtime = int(stat.st_mtime)
+        info.mode = 0o644
+        header = info.tobuf(tarfile.PAX_FORMAT)
+        yield header
+        with open(path, "rb") as src:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+                yield chunk
+        padding = -info.size % tarfile.BLOCKSIZE
+        if padding:
+            yield tarfile.NUL * padding
+        offset += len(header) + info.size + padding
+    # end-of-archive marker, then pad to a full record like tarfile does
+    trailer = 2 * tarfile.BLOCKSIZE
+    trailer += -(offset + trailer) % tarfile.RECORDSIZE
+    yield tarfile.NUL * trailer
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Content-addressed storage for uploaded and generated images.
+
+Each distinct image is stored once under ``<root>/<aa>/<sha256>``. The
+timestamped names in ``uploads/`` are hard links to those blobs, so every
+existing reader (``send_file``, ``Image.open``, thumbnails) keeps working
+while a re-uploaded photo costs only a directory entry. A blob is removed
+once no upload name links to it any more.
+
+Filesystems without hard links (FAT-formatted USB sticks, for example) fall
+back to a plain copy: still correct, just without the disk savings.
+"""
+
+import errno, hashlib, os, shutil, threading
+
+CHUNK_SIZE = 256 * 1024
+SNIFF_BYTES = 16
+# errors meaning "this filesystem can't hard link here", answered with a copy
+_NO_LINK = (errno.EPERM, errno.EXDEV, errno.EMLINK, errno.ENOTSUP)
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+class UnsupportedImage(ValueError):
+    pass
+
+
+def sniff_image_type(header: bytes):
+    # magic numbers of the formats Pillow can open on a stock Pi install
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if header.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header[:2] == b"BM":
+        return "bmp"
+    if header[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff"
+    return None
+
+
+def _fsync_dir(path: str) -> None:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class BlobStore:
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def path_for(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _tmp_path(self, base: str) -> str:
+        return f"{base}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def ingest(self, stream, dest: str, *, max_bytes=None):
+        # One pass over the stream: sniff the image header, enforce the size
+        # limit, hash and write to a temp file, fsync, then rename into the
+        # store and link it at dest (replacing any reserved placeholder).
+        # Returns (digest, size, kind); nothing is left behind on failure.
+        digest = hashlib.sha256()
+        size = 0
+        kind = None
+        head = b""
+        tmp = self._tmp_path(os.path.join(self.root, "incoming"))
+        try:
+            with open(tmp, "wb") as out:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                    size += len(chunk)
+                    if max_bytes is not None and size > max_bytes:
+                        raise UploadTooLarge(f"Upload exceeds {max_bytes} bytes")
+                    if kind is None:
+                        head += chunk
+                        if len(head) < SNIFF_BYTES:
+                            continue
+                        kind = sniff_image_type(head)
+                        if kind is None:
+                            raise UnsupportedImage("Not a supported image file")
+                        chunk, head = head, b""
+                    digest.update(chunk)
+                    out.write(chunk)
+                if kind is None:
+                    # stream shorter than the sniff window
+                    kind = sniff_image_type(head)
+                    if kind is None:
+                        raise UnsupportedImage("Not a supported image file")
+                    digest.update(head)
+                    out.write(head)
+                out.flush()
+                os.fsync(out.fileno())
+            hexdigest = digest.hexdigest()
+            self._commit(tmp, hexdigest)
+            try:
+                self.link(hexdigest, dest)
+            except FileNotFoundError:
+                # the blob was a duplicate whose last name another process
+                # deleted between _commit() and link(): store it again
+                self._commit(tmp, hexdigest)
+                self.link(hexdigest, dest)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return hexdigest, size, kind
+
+    def adopt(self, path: str):
+        # take over a file that was written in place; a duplicate is
+        # swapped for a link to the blob we already have
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                size += len(chunk)
+        hexdigest = digest.hexdigest()
+        blob = self.path_for(hexdigest)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(path, blob)
+                return hexdigest, size
+            except FileExistsError:
+                pass
+            except OSError as exc:
+                if exc.errno not in _NO_LINK:
+                    raise
+                shutil.copyfile(path, blob)
+                return hexdigest, size
+        self.link(hexdigest, path)
+        return hexdigest, size
+
+    def _commit(self, tmp: str, hexdigest: str) -> None:
+        # The blob becomes a second name for tmp, so its link count stays
+        # above one (and release() leaves it alone) until ingest() has
+        # linked dest and removed tmp.
+        blob = self.path_for(hexdigest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        with self._lock:
+            if os.path.exists(blob):
+                return  # duplicate: keep the stored copy, drop the new bytes
+            try:
+                os.link(tmp, blob)
+            except FileExistsError:
+                return
+            except OSError as exc:
+                if exc.errno not in _NO_LINK:
+                    raise
+                shutil.copyfile(tmp, blob)
+        _fsync_dir(os.path.dirname(blob))
+
+    def link(self, hexdigest: str, dest: str) -> None:
+        blob = self.path_for(hexdigest)
+        tmp = self._tmp_path(dest)
+        with self._lock:
+            try:
+                os.link(blob, tmp)
+            except OSError as exc:
+                if exc.errno not in _NO_LINK:
+                    raise
+                shutil.copyfile(blob, tmp)
+        os.replace(tmp, dest)
+        _fsync_dir(os.path.dirname(os.path.abspath(dest)))
+
+    def release(self, hexdigest: str) -> bool:
+        # drop the blob once the store holds the only remaining link
+        blob = self.path_for(hexdigest)
+        with self._lock:
+            try:
+                if os.stat(blob).st_nlink > 1:
+                    return False
+                os.remove(blob)
+            except FileNotFoundError:
+                return False
+        return True
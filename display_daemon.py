@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Standalone display daemon: owns the e-Paper panel and takes frames over a Unix socket.
+
+    python3 display_daemon.py serve
+    python3 display_daemon.py show picture.png
+    python3 display_daemon.py status | clear | sleep
+
+With ``DISPLAY_SOCKET`` set, the web app renders each picture and hands the
+pixels to the daemon instead of driving SPI itself. Any number of web
+workers and CLI tools can submit frames, and the web tier can be restarted
+or scaled without touching the panel. The daemon drives the panel through
+the same ``PanelOwner``/``PanelSession`` pair as the app, so it keeps the
+controller warm between frames and still honours the panel lock file.
+
+Each message is a 15-byte header followed by its payload:
+
+    magic "EPD" | version | kind | flags | width | height | payload length
+       3s           B        B      B       H       H          I    (network order)
+
+Requests are ``FRAME`` (a buffer packed exactly as the driver's
+``display()`` takes it), ``PIXELS`` (raw RGB already oriented for the
+panel), ``IMAGE`` (an encoded file the daemon fits and orients), ``CLEAR``,
+``SLEEP`` and ``STATUS``. Every request gets an ``OK`` or ``ERROR`` reply
+with a JSON payload.
+
+With ``FLAG_FD`` the payload does not travel through the socket. The client
+writes it once into a sealed memfd and passes the descriptor with
+``SCM_RIGHTS``. The daemon maps it read-only; the seals guarantee the
+client can no longer change or shrink it. A ``FRAME`` mapping goes straight
+to the driver. ``PIXELS`` still cost a copy out of Pillow and one into the
+memfd on the client, and the daemon quantizes them into a new buffer, so
+clients that can pack send ``FRAME``. ``STATUS`` also reports the panel's
+size and palette, so a client never needs the driver itself.
+"""
+
+import argparse, fcntl, io, json, logging, mmap, os, signal, socket, socketserver, struct, sys, threading, time
+
+from PIL import Image
+
+from waveshare_epd import orientation
+from panel_owner import PanelBusy, PanelOwner
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"EPD"
+VERSION = 1
+HEADER = struct.Struct("!3sBBBHHI")
+MAX_PAYLOAD = 64 * 1024 * 1024
+ZERO_COPY_MIN = 64 * 1024       # smaller payloads aren't worth a memfd
+DEFAULT_SOCKET = os.path.join("data", "display.sock")
+
+# requests
+FRAME = 1
+PIXELS = 2
+IMAGE = 3
+CLEAR = 4
+SLEEP = 5
+STATUS = 6
+# replies, both with a JSON payload
+OK = 0x80
+ERROR = 0x81
+
+FLAG_FD = 0x01      # payload is in a sealed memfd passed with the header
+FLAG_CLEAR = 0x02   # clear the panel to white before drawing the frame
+_REQUIRED_SEALS = fcntl.F_SEAL_SHRINK | fcntl.F_SEAL_WRITE
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class DisplayDaemonError(RuntimeError):
+    pass
+
+
+# ---------------------------------------------------------------------------
+# framing
+# ---------------------------------------------------------------------------
+
+class Message:
+    def __init__(self, kind: int, flags: int, width: int, height: int, payload, mapping=None):
+        self.kind = kind
+        self.flags = flags
+        self.width = width
+        self.height = height
+        self.payload = payload      # memoryview over a bytearray or a read-only mmap
+        self._mapping = mapping
+
+    def close(self) -> None:
+        self.payload.release()
+        if self._mapping is not None:
+            self._mapping.close()
+            self._mapping = None
+
+
+def _sealed_memfd(view: memoryview) -> int:
+    fd = os.memfd_create("epd-frame", os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+    try:
+        os.ftruncate(fd, len(view))
+        with mmap.mmap(fd, len(view)) as mapping:
+            mapping[:] = view
+        fcntl.fcntl(fd, fcntl.F_ADD_SEALS, _REQUIRED_SEALS | fcntl.F_SEAL_GROW | fcntl.F_SEAL_SEAL)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def send_message(sock, kind: int, payload=b"", *, flags: int = 0, width: int = 0,
+                 height: int = 0, zero_copy: bool = False) -> None:
+    view = memoryview(payload).cast("B")
+    flags &= ~FLAG_FD
+    if zero_copy and len(view) >= ZERO_COPY_MIN and hasattr(os, "memfd_create"):
+        fd = _sealed_memfd(view)
+        try:
+            header = HEADER.pack(MAGIC, VERSION, kind, flags | FLAG_FD, width, height, len(view))
+            socket.send_fds(sock, [header], [fd])
+        finally:
+            os.close(fd)
+        return
+    sock.sendall(HEADER.pack(MAGIC, VERSION, kind, flags, width, height, len(view)))
+    if len(view):
+        sock.sendall(view)
+
+
+def recv_message(sock):
+    # None on a clean EOF between messages
+    header = bytearray(HEADER.size)
+    fds = []
+    got = 0
+    try:
+        while got < HEADER.size:
+            data, new_fds, _, _ = socket.recv_fds(sock, HEADER.size - got, 1)
+            fds.extend(new_fds)
+            if not data:
+                if got == 0 and not fds:
+                    return None
+                raise ProtocolError("Connection closed inside a message header")
+            header[got:got + len(data)] = data
+            got += len(data)
+        magic, version, kind, flags, width, height, length = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ProtocolError("Not a display daemon message (bad magic or version)")
+        if length > MAX_PAYLOAD:
+            raise ProtocolError(f"Payload of {length} bytes exceeds {MAX_PAYLOAD}")
+        if flags & FLAG_FD:
+            if len(fds) != 1:
+                raise ProtocolError("FLAG_FD message without exactly one descriptor")
+            return Message(kind, flags, width, height, *_map_payload(fds.pop(), length))
+        if fds:
+            raise ProtocolError("Unexpected file descriptor")
+        payload = bytearray(length)
+        view = memoryview(payload)
+        got = 0
+        while got < length:
+            n = sock.recv_into(view[got:])
+            if not n:
+                raise ProtocolError("Connection closed inside a message payload")
+            got += n
+        return Message(kind, flags, width, height, view)
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def _map_payload(fd: int, length: int):
+    try:
+        if fcntl.fcntl(fd, fcntl.F_GET_SEALS) & _REQUIRED_SEALS != _REQUIRED_SEALS:
+            raise ProtocolError("Shared payload must be a memfd sealed against writes and shrinking")
+        if os.fstat(fd).st_size < length:
+            raise ProtocolError("Shared payload is shorter than the header says")
+        if not length:
+            return memoryview(b""), None
+        mapping = mmap.mmap(fd, length, prot=mmap.PROT_READ)
+        return memoryview(mapping), mapping
+    except OSError as exc:
+        raise ProtocolError(f"Unusable shared payload: {exc}") from exc
+    finally:
+        os.close(fd)
+
+
+# ---------------------------------------------------------------------------
+# client
+# ---------------------------------------------------------------------------
+
+class DisplayClient:
+    def __init__(self, path: str, *, timeout: float = 600.0, zero_copy: bool = True):
+        self.path = path
+        self.timeout = timeout
+        self.zero_copy = zero_copy
+        self._info = None
+
+    def request(self, kind: int, payload=b"", *, flags: int = 0, width: int = 0,
+                height: int = 0) -> dict:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect(self.path)
+                send_message(sock, kind, payload, flags=flags, width=width, height=height,
+                             zero_copy=self.zero_copy)
+                reply = recv_message(sock)
+        except (OSError, ProtocolError) as exc:
+            raise DisplayDaemonError(f"Display daemon at {self.path} unreachable: {exc}") from exc
+        if reply is None:
+            raise DisplayDaemonError("Display daemon closed the connection without a reply")
+        try:
+            body = json.loads(bytes(reply.payload) or b"{}")
+        finally:
+            reply.close()
+        if reply.kind == ERROR:
+            if body.get("code") == "busy":
+                raise PanelBusy(body.get("error", "Panel busy"))
+            raise DisplayDaemonError(body.get("error", "Display daemon error"))
+        return body
+
+    def panel_info(self) -> dict:
+        # the STATUS fields that never change (size, palette), asked once
+        if self._info is None:
+            self._info = self.status()
+        return self._info
+
+    def panel_size(self):
+        # the panel's native (width, height)
+        info = self.panel_info()
+        return info["width"], info["height"]
+
+    def panel_palette(self):
+        # the driver's PALETTE: RGB per colour code, None for unused codes
+        return tuple(tuple(rgb) if rgb else None for rgb in self.panel_info().get("palette", ()))
+
+    def show_frame(self, buf, width: int, height: int, *, clear: bool = False) -> dict:
+        if isinstance(buf, list):
+            buf = bytes(buf)    # pack() returns a list of byte values
+        return self.request(FRAME, buf, flags=FLAG_CLEAR if clear else 0,
+                            width=width, height=height)
+
+    def show_pixels(self, image, *, clear: bool = False) -> dict:
+        image = image.convert("RGB")
+        return self.request(PIXELS, image.tobytes(), flags=FLAG_CLEAR if clear else 0,
+                            width=image.width, height=image.height)
+
+    def show_image(self, data: bytes, *, clear: bool = False) -> dict:
+        return self.request(IMAGE, data, flags=FLAG_CLEAR if clear else 0)
+
+    def clear(self) -> dict:
+        return self.request(CLEAR)
+
+    def sleep(self) -> dict:
+        return self.request(SLEEP)
+
+    def status(self) -> dict:
+        return self.request(STATUS)
+
+
+# ---------------------------------------------------------------------------
+# server
+# ---------------------------------------------------------------------------
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                message = recv_message(self.request)
+            except ProtocolError as exc:
+                self._reply(ERROR, {"error": str(exc), "code": "bad request"})
+                return
+            except OSError:
+                return
+            if message is None:
+                return
+            try:
+                kind, body = OK, self.server.dispatch(message)
+            except PanelBusy as exc:
+                kind, body = ERROR, {"error": str(exc), "code": "busy"}
+            except ProtocolError as exc:
+                kind, body = ERROR, {"error": str(exc), "code": "bad request"}
+            except Exception as exc:
+                logger.exception("Display request failed")
+                kind, body = ERROR, {"error": f"{type(exc).__name__}: {exc}"}
+            finally:
+                message.close()
+            if not self._reply(kind, body):
+                return
+
+    def _reply(self, kind: int, body: dict) -> bool:
+        try:
+            send_message(self.request, kind, json.dumps(body).encode("utf-8"))
+            return True
+        except OSError:
+            return False
+
+
+class DisplayDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, owner: PanelOwner, *, rotation: int = 0, mirror: str = "none"):
+        self.owner = owner
+        self.rotation = rotation
+        self.mirror = mirror
+        self.started_at = time.time()
+        self.frames = 0
+        self.errors = 0
+        self._stats = threading.Lock()
+        _remove_stale_socket(path)
+        super().__init__(path, _Handler)
+        os.chmod(path, 0o660)       # owner and group (the web app's user) only
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+    def dispatch(self, message: Message) -> dict:
+        panel = self.owner.panel
+        kind, payload = message.kind, message.payload
+        clear = bool(message.flags & FLAG_CLEAR)
+        if kind == STATUS:
+            return self.status()
+        if kind == FRAME:
+            # the epd7in3e buffer: two 4-bit colour codes per byte
+            expected = panel.width * panel.height // 2
+            if (message.width, message.height) != (panel.width, panel.height) or len(payload) != expected:
+                raise ProtocolError(
+                    f"Frame must be {panel.width}x{panel.height} packed into {expected} bytes")
+            return self._show(panel, lambda: payload, clear)
+        if kind == PIXELS:
+            if len(payload) != message.width * message.height * 3:
+                raise ProtocolError("PIXELS payload must be width * height * 3 bytes of RGB")
+            image = Image.frombuffer("RGB", (message.width, message.height), payload, "raw", "RGB", 0, 1)
+            return self._show(panel, lambda: panel.getbuffer(image), clear)
+        if kind == IMAGE:
+            image = Image.open(io.BytesIO(payload)).convert("RGB")
+            size = orientation.logical_size(panel.width, panel.height, self.rotation)
+            image = orientation.apply(image.resize(size), self.rotation, self.mirror)
+            return self._show(panel, lambda: panel.getbuffer(image), clear)
+        if kind == CLEAR:
+            return self._show(panel, None, True)
+        if kind == SLEEP:
+            with self.owner.claim() as session:
+                session.sleep_now()
+            return {}
+        raise ProtocolError(f"Unknown request kind {kind}")
+
+    def _show(self, panel, render, clear: bool) -> dict:
+        # render() runs before taking the panel, so clients convert in parallel
+        began = time.perf_counter()
+        buf = render() if render is not None else None
+        try:
+            with self.owner.claim() as session:
+                try:
+                    warm = not session.wake()
+                    if clear:
+                        panel.Clear()
+                    if buf is not None:
+                        panel.display(buf)
+                    session.done()
+                except Exception:
+                    session.failed()
+                    raise
+        except Exception:
+            with self._stats:
+                self.errors += 1
+            raise
+        with self._stats:
+            self.frames += 1
+        return {"warm": warm, "ms": round((time.perf_counter() - began) * 1000)}
+
+    def status(self) -> dict:
+        panel = self.owner.panel
+        with self._stats:
+            frames, errors = self.frames, self.errors
+        return {
+            "pid": os.getpid(),
+            "width": panel.width,
+            "height": panel.height,
+            "palette": getattr(panel, "PALETTE", None),
+            "rotation": self.rotation,
+            "mirror": self.mirror,
+            "awake": self.owner.session.awake,
+            "busy": self.owner.busy(),
+            "frames": frames,
+            "errors": errors,
+            "uptime": round(time.time() - self.started_at),
+        }
+
+
+def _remove_stale_socket(path: str) -> None:
+    # a socket file left by a crashed daemon would make bind() fail
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+            return
+    raise OSError(f"A display daemon is already listening on {path}")
+
+
+def _env_int(name: str, fallback: int) -> int:
+    try:
+        return int(os.environ.get(name, fallback))
+    except ValueError:
+        return fallback
+
+
+def serve(path: str) -> int:
+    from waveshare_epd import epd7in3e    # hardware only on the serving side
+
+    owner = PanelOwner(
+        epd7in3e.EPD,
+        os.environ.get("PANEL_LOCK_FILE") or os.path.join("data", "panel.lock"),
+        idle=_env_int("PANEL_IDLE_SEC", 120),
+        timeout=_env_int("PANEL_LOCK_TIMEOUT", 300) or None,
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    server = DisplayDaemon(
+        path, owner,
+        rotation=orientation.normalize_rotation(os.environ.get("EPD_ROTATION", "0")),
+        mirror=orientation.normalize_mirror(os.environ.get("EPD_MIRROR", "none")),
+    )
+    # shutdown() waits for serve_forever(), so it can't run on this thread
+    stop = lambda *_: threading.Thread(target=server.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info("Display daemon listening on %s", path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        owner.close()
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--socket", default=os.environ.get("DISPLAY_SOCKET") or DEFAULT_SOCKET)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("serve", help="own the panel and accept frames")
+    show = commands.add_parser("show", help="display an image file")
+    show.add_argument("image")
+    show.add_argument("--clear", action="store_true", help="clear to white first, as the web UI does")
+    commands.add_parser("clear", help="clear the panel to white")
+    commands.add_parser("sleep", help="put the panel into deep sleep now")
+    commands.add_parser("status", help="print the daemon's status")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.command == "serve":
+        return serve(args.socket)
+
+    client = DisplayClient(args.socket)
+    try:
+        if args.command == "show":
+            with open(args.image, "rb") as fh:
+                reply = client.show_image(fh.read(), clear=args.clear)
+        else:
+            reply = getattr(client, args.command)()
+    except (OSError, DisplayDaemonError, PanelBusy) as exc:
+        print(exc, file=sys.stderr)
+        return 1
+    print(json.dumps(reply))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
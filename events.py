@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Event bus behind the ``/events`` Server-Sent Events stream.
+
+Display updates and generation jobs publish a stage each time they move
+(queued, converting, transferring, panel busy, done, ...). The bus stamps
+every event with the time since the job started and how long the previous
+stage took, so a subscriber can see exactly which stage is slow.
+
+Recent events are kept in a small SQLite table shared by every process of
+the app, so a browser connected to one gunicorn worker sees the jobs run by
+the others. Ids come from an AUTOINCREMENT key and are never reused, so a
+reconnecting browser can resume from ``Last-Event-ID`` without missing
+anything. Events published in the same process wake a stream at once; the
+others' are picked up within ``poll`` seconds.
+"""
+
+import collections, json, logging, sqlite3, threading, time
+
+from lazy_sqlite import LazySqlite
+
+logger = logging.getLogger(__name__)
+
+FINAL_STAGES = ("done", "failed")
+
+
+class EventBus(LazySqlite):
+    def __init__(self, db_path: str, *, keep: int = 500, max_active: int = 500,
+                 poll: float = 0.5):
+        super().__init__(db_path)
+        self.keep = keep
+        self.max_active = max_active
+        self.poll = poll
+        self._cond = threading.Condition()
+        self._active = collections.OrderedDict()   # job -> (kind, started, stage, since)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, job TEXT NOT NULL,"
+            " stage TEXT NOT NULL, body TEXT NOT NULL)"
+        )
+
+    def _configure(self, db) -> None:
+        # progress events are worth nothing after a power cut; skip the fsyncs
+        db.execute("PRAGMA synchronous=NORMAL")
+
+    def _after_fork(self) -> None:
+        super()._after_fork()
+        self._cond = threading.Condition()
+        self._active = collections.OrderedDict()
+
+    def publish(self, job: str, kind: str, stage: str, **data) -> dict:
+        # the stage timings come from this process, which runs the job
+        now = time.time()
+        with self._cond:
+            _, started, previous, since = self._active.get(job, (kind, now, None, now))
+            event = dict(
+                data,
+                job=job,
+                kind=kind,
+                stage=stage,
+                at=now,
+                elapsed_ms=round((now - started) * 1000),
+            )
+            if previous is not None:
+                event["previous"] = previous
+                event["previous_ms"] = round((now - since) * 1000)
+            if stage in FINAL_STAGES:
+                self._active.pop(job, None)
+            else:
+                self._active[job] = (kind, started, stage, now)
+                self._active.move_to_end(job)
+                while len(self._active) > self.max_active:
+                    self._active.popitem(last=False)   # abandoned jobs
+            try:
+                with self._lock, self._conn as db:
+                    cur = db.execute(
+                        "INSERT INTO events (job, stage, body) VALUES (?, ?, ?)",
+                        (job, stage, json.dumps(event, default=str)),
+                    )
+                    event["id"] = cur.lastrowid
+                    db.execute("DELETE FROM events WHERE id <= ?", (event["id"] - self.keep,))
+            except sqlite3.Error:
+                # a lost progress event must never fail the job itself
+                logger.exception("Could not record %s event for job %s", stage, job)
+            self._cond.notify_all()
+        return event
+
+    def active(self) -> list:
+        # jobs of every process whose latest event isn't final
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT body FROM events WHERE id IN (SELECT MAX(id) FROM events GROUP BY job)"
+                " ORDER BY id"
+            ).fetchall()
+        jobs = []
+        for (body,) in rows:
+            event = json.loads(body)
+            if event["stage"] in FINAL_STAGES:
+                continue
+            started = event["at"] - event["elapsed_ms"] / 1000
+            jobs.append({
+                "job": event["job"],
+                "kind": event["kind"],
+                "stage": event["stage"],
+                "elapsed_ms": round((now - started) * 1000),
+                "stage_ms": round((now - event["at"]) * 1000),
+            })
+        return jobs[-self.max_active:]
+
+    def last_id(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+    def _since(self, last_id: int, limit: int = 500) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, body FROM events WHERE id > ? ORDER BY id LIMIT ?", (last_id, limit)
+            ).fetchall()
+        return [dict(json.loads(body), id=event_id) for event_id, body in rows]
+
+    def stream(self, last_id: int = 0, heartbeat: float = 15.0):
+        # yields events newer than last_id as they arrive, or None after
+        # `heartbeat` quiet seconds so the caller can keep the connection alive
+        quiet_since = time.monotonic()
+        while True:
+            with self._cond:
+                events = self._since(last_id)
+                if not events:
+                    self._cond.wait(self.poll)
+            if not events:
+                events = self._since(last_id)
+            if not events:
+                if time.monotonic() - quiet_since >= heartbeat:
+                    quiet_since = time.monotonic()
+                    yield None
+                continue
+            for event in events:
+                last_id = event["id"]
+                yield event
+            quiet_since = time.monotonic()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Background job runner for Hugging Face image generation.
+
+``/generate`` used to hold a request thread for the whole 10-60 s inference
+call. Jobs now go onto a bounded worker pool instead, with a per-model
+concurrency cap so one slow checkpoint can't occupy every worker; callers
+get a job id back immediately and poll (or stream) its status.
+
+Each status change is also written to a ``JobStore``. Under gunicorn the
+status poll may reach another worker than the one running the job, and that
+worker answers from the shared table.
+
+``GenerationCache`` remembers which saved image an identical request
+produced, so repeating a prompt costs neither latency nor API quota.
+"""
+
+import collections, hashlib, json, logging, re, sqlite3, threading, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+from lazy_sqlite import LazySqlite
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class GenerationJob:
+    def __init__(self, model: str, params: dict):
+        self.id = uuid.uuid4().hex
+        self.model = model
+        self.params = params
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.slot = None        # model whose concurrency slot the job holds
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "model": self.model,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobStore(LazySqlite):
+    # job id -> the latest to_dict() of the job, for every process
+
+    def __init__(self, db_path: str, *, keep: int = 200):
+        super().__init__(db_path)
+        self.keep = keep
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS generation_jobs ("
+            " id TEXT PRIMARY KEY, body TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def save(self, job: dict) -> None:
+        with self._lock, self._conn as db:
+            db.execute(
+                "INSERT OR REPLACE INTO generation_jobs (id, body, updated_at) VALUES (?, ?, ?)",
+                (job["id"], json.dumps(job, default=str), time.time()),
+            )
+            if job["status"] in (DONE, FAILED):
+                db.execute(
+                    "DELETE FROM generation_jobs WHERE id NOT IN"
+                    " (SELECT id FROM generation_jobs ORDER BY updated_at DESC LIMIT ?)",
+                    (self.keep,),
+                )
+
+    def get(self, job_id: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body FROM generation_jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+class GenerationService:
+    def __init__(self, run, *, workers: int = 2, per_model: int = 1,
+                 keep_jobs: int = 200, listener=None, store=None):
+        # run(job) does the work and returns the job result (a dict);
+        # listener(job), if given, is told about every status change, and
+        # store (a JobStore) records it for the other processes
+        self.run = run
+        self.listener = listener
+        self.store = store
+        self.workers = max(1, workers)
+        self.per_model = max(1, per_model)
+        self.keep_jobs = keep_jobs
+        self._lock = threading.Lock()
+        self._finished = threading.Condition(self._lock)   # a job finished or gave up a slot
+        self._jobs = collections.OrderedDict()
+        self._pending = collections.deque()
+        self._running = collections.Counter()
+        self._active = 0
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="generate")
+
+    def submit(self, model: str, params: dict) -> GenerationJob:
+        job = GenerationJob(model, params)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._forget_old()
+            self._notify(job)
+            self._dispatch()
+        return job
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def status(self, job_id: str):
+        # to_dict() of a job run by this process or, failing that, any other
+        job = self.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        return self.store.get(job_id) if self.store is not None else None
+
+    def as_completed(self, jobs, timeout=None):
+        # yield jobs in the order they finish (batch endpoints stream these);
+        # stops early once timeout seconds pass without all of them finishing
+        remaining = list(jobs)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while remaining:
+            with self._finished:
+                done = [job for job in remaining if job.finished]
+                while not done:
+                    wait = None if deadline is None else deadline - time.monotonic()
+                    if wait is not None and wait <= 0:
+                        return
+                    self._finished.wait(wait)
+                    done = [job for job in remaining if job.finished]
+            for job in done:
+                remaining.remove(job)
+                yield job
+
+    def queue_depth(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def running(self) -> int:
+        with self._lock:
+            return self._active
+
+    def use_model(self, job: GenerationJob, model: str) -> None:
+        # Called from run(job) before it falls back to another model: the job
+        # gives up its current model's slot and waits for one on `model`, so
+        # per_model holds for fallback models too.
+        with self._lock:
+            if job.slot == model:
+                return
+            self._running[job.slot] -= 1
+            job.slot = None
+            self._dispatch()
+            self._finished.notify_all()
+            while self._running[model] >= self.per_model:
+                self._finished.wait()
+            self._running[model] += 1
+            job.slot = model
+
+    def _forget_old(self) -> None:
+        # keep the newest keep_jobs entries; unfinished jobs are never dropped
+        excess = len(self._jobs) - self.keep_jobs
+        for job_id in list(self._jobs):
+            if excess <= 0:
+                break
+            if self._jobs[job_id].finished:
+                del self._jobs[job_id]
+                excess -= 1
+
+    def _notify(self, job: GenerationJob) -> None:
+        if self.store is not None:
+            try:
+                self.store.save(job.to_dict())
+            except sqlite3.Error:
+                logger.exception("Could not record job %s", job.id)
+        if self.listener is None:
+            return
+        try:
+            self.listener(job)
+        except Exception:
+            logger.exception("Generation listener failed for job %s", job.id)
+
+    def _dispatch(self) -> None:
+        # called with the lock held: start every pending job that fits within
+        # the worker pool and its model's concurrency limit, oldest first
+        for job in list(self._pending):
+            if self._active >= self.workers:
+                break
+            if self._running[job.model] >= self.per_model:
+                continue
+            self._pending.remove(job)
+            self._running[job.model] += 1
+            job.slot = job.model
+            self._active += 1
+            job.status = RUNNING
+            job.started_at = time.time()
+            self._notify(job)
+            self._pool.submit(self._execute, job)
+
+    def _execute(self, job: GenerationJob) -> None:
+        status, error = FAILED, None
+        try:
+            job.result = self.run(job)
+            status = DONE
+        except Exception as exc:
+            logger.exception("Generation job %s failed", job.id)
+            error = str(exc)
+        finally:
+            # finished (for as_completed) only once the store has the result
+            with self._lock:
+                job.error = error
+                job.finished_at = time.time()
+                job.status = status
+                self._notify(job)
+                if job.slot is not None:
+                    self._running[job.slot] -= 1
+                    job.slot = None
+                self._active -= 1
+                self._dispatch()
+                self._finished.notify_all()
+
+
+class GenerationCache(LazySqlite):
+    # (normalized prompt, model, size, seed) -> filename of the saved result.
+    # Entries point at images in the library, so a hit is only valid while
+    # that file still exists; the caller checks and calls forget() otherwise.
+
+    def __init__(self, db_path: str):
+        super().__init__(db_path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS generation_cache ("
+            " key TEXT PRIMARY KEY, filename TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self.hits = 0
+        self.misses = 0
+        self.forced = 0
+
+    @staticmethod
+    def make_key(prompt: str, model: str, width: int, height: int, seed=None) -> str:
+        # prompt should already be cleaned (no <!-- tags -->); whitespace
+        # differences don't change the image, so they don't change the key
+        normalized = re.sub(r"\s+", " ", prompt or "").strip()
+        payload = json.dumps([normalized, model, width, height, seed])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def lookup(self, key: str, *, force: bool = False):
+        if force:
+            with self._lock:
+                self.forced += 1
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT filename FROM generation_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return row[0] if row else None
+
+    def store(self, key: str, filename: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO generation_cache (key, filename, created_at)"
+                " VALUES (?, ?, ?)",
+                (key, filename, time.time()),
+            )
+
+    def forget(self, key: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM generation_cache WHERE key = ?", (key,))
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM generation_cache").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "forced": self.forced,
+                "entries": entries,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Retries, backoff and circuit breaking around Hugging Face inference calls.
+
+Serverless models answer 503 while they cold-load, and the router times out
+under load; both used to surface straight out of ``/generate`` and invite the
+user to click again, which only keeps the model busier. Transient failures are
+now retried a bounded number of times with exponential backoff and jitter. A
+model that keeps failing has its circuit opened for a while, and the request
+falls through to the next model in the list instead.
+"""
+
+import logging, random, threading, time
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# Transport failures of the HTTP stacks huggingface_hub can run on, by
+# package and class name so none of them has to be importable. Their
+# connection errors are not subclasses of the builtin ConnectionError.
+# Package names match by prefix, which also covers renamed majors (httpx2).
+TRANSIENT_ERRORS = {
+    "httpx": {"TimeoutException", "NetworkError", "RemoteProtocolError", "ProxyError"},
+    "httpcore": {"TimeoutException", "NetworkError", "RemoteProtocolError", "ProxyError"},
+    "requests": {"ConnectionError", "Timeout", "ChunkedEncodingError"},
+    "urllib3": {"TimeoutError", "NewConnectionError", "ProtocolError"},
+    "aiohttp": {"ClientConnectionError", "ServerTimeoutError", "ClientPayloadError"},
+}
+
+
+class ModelUnavailable(RuntimeError):
+    pass
+
+
+def status_of(exc):
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def is_transient(exc) -> bool:
+    # worth retrying: overloaded/cold models, gateway errors, timeouts and
+    # dropped connections
+    if status_of(exc) in RETRY_STATUS:
+        return True
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    for cls in type(exc).__mro__:
+        package = cls.__module__.split(".")[0]
+        for prefix, names in TRANSIENT_ERRORS.items():
+            if package.startswith(prefix) and cls.__name__ in names:
+                return True
+    return False
+
+
+def retry_after(exc):
+    # seconds from a Retry-After header, if the server sent a numeric one
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        return max(0.0, float(headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    # Opens after `failures` consecutive transient failures; after
+    # `reset_after` seconds one trial call is let through (half-open) and its
+    # outcome closes or re-opens the circuit.
+
+    def __init__(self, failures: int = 3, reset_after: float = 60.0):
+        self.failures = max(1, failures)
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self._count = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return CLOSED
+        if time.monotonic() - self._opened_at >= self.reset_after:
+            return HALF_OPEN
+        return OPEN
+
+    def retry_in(self) -> float:
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self.reset_after - (time.monotonic() - self._opened_at))
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._count = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._count += 1
+            if self._trial or self._count >= self.failures:
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+
+class ResilientInference:
+    def __init__(self, *, retries: int = 2, backoff: float = 1.0,
+                 max_backoff: float = 20.0, breaker_failures: int = 3,
+                 breaker_reset: float = 60.0, sleep=time.sleep):
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(model)
+            if breaker is None:
+                breaker = CircuitBreaker(self.breaker_failures, self.breaker_reset)
+                self._breakers[model] = breaker
+            return breaker
+
+    def states(self) -> dict:
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {model: breaker.state for model, breaker in breakers.items()}
+
+    def delay(self, attempt: int, exc=None) -> float:
+        # "full jitter": uniform over [0, capped exponential], so clients
+        # that failed together don't all come back together
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        hinted = retry_after(exc) if exc is not None else None
+        if hinted is not None:
+            delay = max(delay, min(hinted, self.max_backoff))
+        return delay
+
+    def call(self, models, attempt, *, switch=None):
+        # attempt(model) performs one request. models are tried in order;
+        # returns (result, model that produced it). Non-transient errors are
+        # raised immediately: another model won't fix a bad request.
+        # switch(model), if given, runs before the first attempt on each
+        # model, e.g. to take that model's concurrency slot.
+        last_exc = None
+        for model in models:
+            breaker = self.breaker(model)
+            if not breaker.allow():
+                logger.info("Skipping %s, circuit open for %.0fs", model, breaker.retry_in())
+                continue
+            if switch is not None:
+                switch(model)
+            for number in range(self.retries + 1):
+                try:
+                    result = attempt(model)
+                except Exception as exc:
+                    if not is_transient(exc):
+                        breaker.record_success()  # the model answered
+                        raise
+                    last_exc = exc
+                    logger.warning("Inference on %s failed (attempt %d/%d): %s",
+                                   model, number + 1, self.retries + 1, exc)
+                    if number < self.retries:
+                        self.sleep(self.delay(number, exc))
+                    continue
+                breaker.record_success()
+                return result, model
+            breaker.record_failure()
+        if last_exc is not None:
+            raise ModelUnavailable(f"All models failed, last error: {last_exc}") from last_exc
+        raise ModelUnavailable("All models are temporarily unavailable, try again shortly")
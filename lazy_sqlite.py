@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""One SQLite connection per process, opened on first use.
+
+The app module may be imported before gunicorn forks its workers
+(``--preload``), and a SQLite connection must not be used on both sides of
+a fork(). Classes that keep a database derive from ``LazySqlite``: the
+connection is opened by whichever process first uses it, and a forked child
+drops the inherited one and opens its own.
+"""
+
+import os, sqlite3, threading
+
+
+class LazySqlite:
+    def __init__(self, db_path: str, *, row_factory=None):
+        parent = os.path.dirname(db_path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        self._db_path = db_path
+        self._row_factory = row_factory
+        self._db = None
+        self._inherited = []
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    @property
+    def _conn(self):
+        if self._db is None:
+            db = sqlite3.connect(self._db_path, check_same_thread=False)
+            if self._row_factory is not None:
+                db.row_factory = self._row_factory
+            db.execute("PRAGMA journal_mode=WAL")
+            self._configure(db)
+            self._db = db
+        return self._db
+
+    def _configure(self, db) -> None:
+        # per-connection PRAGMAs for subclasses
+        pass
+
+    def _after_fork(self) -> None:
+        # the parent's connection stays referenced so the child never closes
+        # it (closing would roll back or unlock on the parent's behalf)
+        if self._db is not None:
+            self._inherited.append(self._db)
+        self._db = None
+        self._lock = threading.Lock()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Re-encode existing generated images with the configured storage codec.
+
+    python3 migrate_storage.py [--format webp] [--include-uploads] [--dry-run]
+
+Each image is written under the same timestamped name with the new
+extension; its index metadata (model, preset, pin, last displayed) carries
+over and the old file is removed along with its thumbnail and blob. Run it
+while the web UI is stopped.
+"""
+
+import argparse, os, sys
+
+from PIL import Image
+
+import app
+from storage_codec import CODECS, StorageCodec, normalize_ext
+
+
+def collect_entries(include_uploads: bool) -> list:
+    entries = []
+    cursor = None
+    while True:
+        page = app.upload_index.page(limit=500, cursor=cursor)
+        entries.extend(page["items"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    if not include_uploads:
+        entries = [entry for entry in entries if entry["source"] == "generated"]
+    return entries
+
+
+def migrate_entry(entry: dict, codec: StorageCodec) -> int:
+    name = entry["filename"]
+    stem, _ = os.path.splitext(name)
+    new_name = app.reserve_unique_filename(stem + codec.ext)
+    dest = os.path.join(app.UPLOAD_FOLDER, new_name)
+    try:
+        with Image.open(os.path.join(app.UPLOAD_FOLDER, name)) as img:
+            img.load()
+            codec.save(img, dest)
+        digest, size = app.blob_store.adopt(dest)
+    except Exception:
+        app.release_reserved_filename(new_name)
+        raise
+    app.upload_index.add(
+        new_name,
+        entry["source"],
+        model=entry["model"],
+        preset=entry["preset"],
+        subject=entry["subject"],
+        size=size,
+        created_at=entry["created_at"],
+        sha256=digest,
+    )
+    if entry["pinned"]:
+        app.upload_index.set_pinned(new_name, True)
+    if entry["last_displayed"]:
+        app.upload_index.mark_displayed(new_name, entry["last_displayed"])
+    app.remove_upload(name)
+    return size
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--format", choices=sorted(CODECS), help="defaults to GEN_STORAGE_FORMAT")
+    parser.add_argument("--include-uploads", action="store_true",
+                        help="also re-encode manual uploads, not just generated images")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+
+    codec = app.GEN_STORAGE
+    if args.format:
+        codec = StorageCodec(args.format, quality=codec.quality,
+                             png_compress_level=codec.png_compress_level)
+
+    pending = [
+        entry for entry in collect_entries(args.include_uploads)
+        if normalize_ext(os.path.splitext(entry["filename"])[1]) != codec.ext
+    ]
+    print(f"{len(pending)} image(s) to convert to {codec.name}")
+    if args.dry_run:
+        return 0
+
+    before = after = failed = 0
+    for entry in pending:
+        try:
+            size = migrate_entry(entry, codec)
+        except (OSError, ValueError, Image.DecompressionBombError) as exc:
+            failed += 1
+            print(f"  skipped {entry['filename']}: {exc}", file=sys.stderr)
+            continue
+        before += entry["size"]
+        after += size
+    print(f"converted {len(pending) - failed}, failed {failed}: "
+          f"{before / 1e6:.1f} MB -> {after / 1e6:.1f} MB")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Exclusive ownership of the e-Paper panel, within and across processes.
+
+The driver talks to the panel through one SPI bus and a handful of GPIO
+lines. Two writers that interleave their commands leave the controller in
+an undefined state. Inside one process a thread lock is enough. Across
+processes (the web app, the display daemon, scripts) the owner also takes
+an ``flock`` on a lock file, which the kernel drops when a crashed
+process's file descriptor closes.
+
+A process keeps the file lock for as long as its ``PanelSession`` keeps the
+controller awake. The controller is then never initialised by one process
+and driven by another. A worker waiting for the panel holds a shared lock
+on ``<lock file>.want``. The warm owner's idle timer notices it and puts the
+panel to sleep early, so the waiting worker gets it within about a second.
+
+The driver object itself is created on first use instead of at import, so
+it works the same under ``python app.py`` and under gunicorn.
+"""
+
+import fcntl, os, threading, time
+from contextlib import contextmanager
+from panel_session import PanelSession
+
+
+class PanelBusy(TimeoutError):
+    pass
+
+
+class PanelOwner:
+    def __init__(self, factory, lock_path: str, *, idle: float = 120.0,
+                 timeout=None, poll: float = 0.5):
+        # factory() builds the driver object; timeout (seconds, None = wait
+        # forever) bounds how long acquire() waits for another owner
+        self.factory = factory
+        self.lock_path = os.path.abspath(lock_path)
+        self.want_path = self.lock_path + ".want"
+        self.idle = idle
+        self.timeout = timeout
+        self.poll = poll
+        self.lock = threading.Lock()
+        self.session = None
+        self._create = threading.Lock()
+        self._fd = None         # flock'd lock file while this process owns the panel
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    @property
+    def panel(self):
+        # the driver object, created on first use; building it does not
+        # touch SPI, so it is safe without owning the panel
+        if self.session is None:
+            with self._create:
+                if self.session is None:
+                    self.session = PanelSession(
+                        self.factory(), lock=self.lock, idle=self.idle, poll=self.poll,
+                        should_yield=self._contended, on_sleep=self._unlock_file,
+                    )
+        return self.session.panel
+
+    def busy(self) -> bool:
+        # True while a thread of this process is updating the panel
+        return self.lock.locked()
+
+    def acquire(self, timeout=None, on_wait=None) -> PanelSession:
+        # Blocks until this thread owns the panel and returns its session.
+        # on_wait() is called once if the panel is busy. Raises PanelBusy
+        # after `timeout` seconds (default: the owner's timeout).
+        self.panel      # build the driver before waiting, not while holding the lock
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self.lock.acquire(blocking=False):
+            if on_wait is not None:
+                on_wait()
+                on_wait = None
+            if not self.lock.acquire(timeout=-1 if deadline is None else timeout):
+                raise PanelBusy(f"Panel still busy after {timeout:g}s")
+        try:
+            if self._fd is None:
+                self._lock_file(deadline, on_wait)
+        except BaseException:
+            self.lock.release()
+            raise
+        return self.session
+
+    def release(self) -> None:
+        # after an update that left the panel asleep (idle 0, or a failure),
+        # another process may have it straight away
+        try:
+            if not self.session.awake:
+                self._unlock_file()
+        finally:
+            self.lock.release()
+
+    @contextmanager
+    def claim(self, timeout=None, on_wait=None):
+        session = self.acquire(timeout, on_wait)
+        try:
+            yield session
+        finally:
+            self.release()
+
+    def close(self) -> None:
+        # process exit: sleep the panel if this process left it awake
+        if self.session is None:
+            return
+        try:
+            self.session.close()
+        finally:
+            with self.lock:
+                self._unlock_file()
+
+    def _lock_file(self, deadline, on_wait) -> None:
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        want = None
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    pass
+                if want is None:
+                    # ask a warm owner in another process to hand over now
+                    want = os.open(self.want_path, os.O_RDWR | os.O_CREAT, 0o644)
+                    fcntl.flock(want, fcntl.LOCK_SH)
+                    if on_wait is not None:
+                        on_wait()
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise PanelBusy(f"Panel held by another process ({self._holder()})")
+                time.sleep(self.poll)
+        except BaseException:
+            os.close(fd)
+            raise
+        finally:
+            if want is not None:
+                os.close(want)
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode("ascii"))
+        self._fd = fd
+
+    def _unlock_file(self) -> None:
+        if self._fd is None:
+            return
+        fd, self._fd = self._fd, None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def _contended(self) -> bool:
+        # True while some process waits in _lock_file()
+        try:
+            fd = os.open(self.want_path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def _holder(self) -> str:
+        try:
+            with open(self.lock_path, encoding="ascii") as fh:
+                return f"pid {fh.read().strip() or '?'}"
+        except OSError:
+            return "pid ?"
+
+    def _after_fork(self) -> None:
+        # A forked worker inherits the parent's lock state but not its
+        # threads. Closing the inherited fd leaves the parent's flock alone.
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self.lock = threading.Lock()
+        self._create = threading.Lock()
+        if self.session is not None:
+            self.session.lock = self.lock
+            self.session.awake = False
+            self.session._timer = None
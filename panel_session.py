@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Keep-warm session around the e-Paper driver.
+
+Every update used to run ``init()`` then ``sleep()``. ``sleep()`` alone waits
+2 s and closes SPI through ``module_exit()``. The next update then reopened
+SPI, reset the controller and replayed the whole register setup. The session
+keeps the module initialised between updates and only sends it to deep sleep
+after ``idle`` seconds without one, so back-to-back updates skip both.
+
+The panel itself is not left driven while idle: every refresh already ends
+with POWER_OFF inside ``TurnOnDisplay()``. Only the controller stays awake.
+An idle window of 0 restores the old sleep-after-every-update behaviour.
+
+``should_yield`` lets another process cut the idle window short: the timer
+then checks it every ``poll`` seconds and sleeps as soon as it returns True.
+``on_sleep`` runs after every sleep, so the owner can hand the panel over.
+"""
+
+import logging, threading, time
+
+logger = logging.getLogger(__name__)
+
+
+class PanelSession:
+    def __init__(self, panel, *, lock, idle: float = 120.0, poll: float = 1.0,
+                 should_yield=None, on_sleep=None):
+        # lock is the one every panel user already holds around SPI work;
+        # the idle timer takes it too, so it never sleeps mid-update
+        self.panel = panel
+        self.lock = lock
+        self.idle = idle
+        self.poll = poll
+        self.should_yield = should_yield
+        self.on_sleep = on_sleep
+        self.awake = False
+        self._timer = None
+        self._ticket = 0
+
+    def wake(self) -> bool:
+        # call with the lock held; returns True when init() had to run
+        self._cancel()
+        if self.awake:
+            return False
+        self.panel.init()
+        self.awake = True
+        return True
+
+    def done(self) -> None:
+        # call with the lock held once an update has finished
+        if self.idle <= 0:
+            self._sleep()
+            return
+        self._cancel()
+        self._arm(self._ticket, time.monotonic() + self.idle)
+
+    def failed(self) -> None:
+        # after an error the controller state is unknown: put it to sleep so
+        # the next update starts from a full init()
+        self._cancel()
+        try:
+            self._sleep(force=True)
+        except Exception:
+            logger.exception("Panel sleep after a failed update also failed")
+            self.awake = False
+
+    def sleep_now(self) -> None:
+        # call with the lock held: deep sleep now instead of after the idle window
+        self._cancel()
+        self._sleep()
+
+    def close(self) -> None:
+        # process exit: never leave the controller powered
+        with self.lock:
+            self.sleep_now()
+
+    def _cancel(self) -> None:
+        self._ticket += 1
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _arm(self, ticket: int, deadline: float) -> None:
+        delay = max(0.0, deadline - time.monotonic())
+        if self.should_yield is not None:
+            delay = min(delay, self.poll)
+        self._timer = threading.Timer(delay, self._sleep_if_idle, args=(ticket, deadline))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _sleep(self, force: bool = False) -> None:
+        if self.awake or force:
+            self.awake = False
+            try:
+                self.panel.sleep()
+            finally:
+                if self.on_sleep is not None:
+                    self.on_sleep()
+
+    def _sleep_if_idle(self, ticket: int, deadline: float) -> None:
+        with self.lock:
+            if ticket != self._ticket:
+                return  # an update came in after this timer was armed
+            if time.monotonic() < deadline and not (self.should_yield and self.should_yield()):
+                self._arm(ticket, deadline)
+                return
+            self._timer = None
+            try:
+                self._sleep()
+            except Exception:
+                logger.exception("Idle panel sleep failed")
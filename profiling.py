@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Opt-in cProfile runs for single requests and generation jobs.
+
+A request carrying ``X-Profile: 1`` (or every request, with
+``PROFILE_MODE=always``) runs under cProfile. The raw ``.prof`` file, for
+snakeviz or ``pstats``, and a short text summary are written to the
+diagnostics folder. Only the newest ``keep`` profiles are kept.
+
+Only one profile runs at a time. On Python 3.12+ cProfile is process-wide,
+so a second concurrent request simply runs unprofiled.
+"""
+
+import cProfile, io, os, pstats, re, threading, time, uuid
+
+_NAME_RE = re.compile(r"^[0-9]{8}-[0-9]{6}-[a-z0-9_-]+-[0-9a-f]{8}$")
+
+
+class ProfileStore:
+    def __init__(self, folder: str, *, keep: int = 20, top: int = 40):
+        self.folder = os.path.abspath(folder)
+        self.keep = keep
+        self.top = top
+        self._busy = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def run(self, label: str, fn, *args, **kwargs):
+        # returns (fn's result, profile name or None if another one is running)
+        if not self._busy.acquire(blocking=False):
+            return fn(*args, **kwargs), None
+        profiler = cProfile.Profile()
+        began = time.perf_counter()
+        try:
+            profiler.enable()
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                profiler.disable()
+            name = self._save(label, profiler, time.perf_counter() - began)
+        finally:
+            self._busy.release()
+        return result, name
+
+    def _save(self, label: str, profiler, duration: float) -> str:
+        slug = re.sub(r"[^a-z0-9_-]+", "-", label.lower()).strip("-") or "request"
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}-{uuid.uuid4().hex[:8]}"
+        base = os.path.join(self.folder, name)
+        profiler.dump_stats(base + ".prof")
+        text = io.StringIO()
+        text.write(f"{label}: {duration * 1000:.1f} ms wall time\n\n")
+        stats = pstats.Stats(profiler, stream=text)
+        stats.sort_stats("cumulative").print_stats(self.top)
+        with open(base + ".txt", "w", encoding="utf-8") as fh:
+            fh.write(text.getvalue())
+        self.prune()
+        return name
+
+    def prune(self) -> None:
+        names = sorted({os.path.splitext(f)[0] for f in os.listdir(self.folder)
+                        if _NAME_RE.match(os.path.splitext(f)[0])})
+        for name in names[:-self.keep] if self.keep else []:
+            for ext in (".prof", ".txt"):
+                try:
+                    os.remove(os.path.join(self.folder, name + ext))
+                except FileNotFoundError:
+                    pass
+
+    def list(self) -> list:
+        out = []
+        for entry in os.scandir(self.folder):
+            name, ext = os.path.splitext(entry.name)
+            if ext != ".prof" or not _NAME_RE.match(name):
+                continue
+            stat = entry.stat()
+            label = name[16:-9]
+            out.append({"name": name, "label": label, "size": stat.st_size,
+                        "created_at": stat.st_mtime})
+        out.sort(key=lambda item: item["name"], reverse=True)
+        return out
+
+    def path_for(self, name: str, ext: str) -> str:
+        # ValueError for anything that isn't one of our profile names
+        if not _NAME_RE.match(name) or ext not in (".prof", ".txt"):
+            raise ValueError("Invalid profile name")
+        return os.path.join(self.folder, name + ext)
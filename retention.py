@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Retention policy for the uploads library.
+
+A background compactor keeps the library within the configured limits
+(total bytes, entry count, age). Pinned entries are never evicted; the rest
+go least-recently-displayed first. Removal itself is delegated to the app so
+thumbnails, blobs and caches are cleaned the same way as a manual delete.
+"""
+
+import logging, threading, time
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy:
+    def __init__(self, index, remove, *, max_bytes=0, max_count=0,
+                 max_age=0, interval=3600):
+        self.index = index
+        self.remove = remove
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        self.max_age = max_age
+        self.interval = interval
+        self._wake = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_bytes or self.max_count or self.max_age)
+
+    def enforce(self) -> list:
+        if not self.enabled:
+            return []
+        now = time.time()
+        count, total = self.index.usage()
+        evicted = []
+        for entry in self.index.eviction_candidates():
+            last_used = entry["last_displayed"] or entry["created_at"]
+            expired = self.max_age and now - last_used > self.max_age
+            over = (
+                (self.max_count and count > self.max_count)
+                or (self.max_bytes and total > self.max_bytes)
+            )
+            if not (expired or over):
+                # candidates come oldest first, so once we are within limits
+                # nothing later can be expired either
+                break
+            try:
+                self.remove(entry["filename"])
+            except OSError:
+                logger.exception("Retention could not remove %s", entry["filename"])
+                continue
+            evicted.append(entry["filename"])
+            count -= 1
+            digest = entry["sha256"]
+            if not digest or not self.index.names_for_hash(digest):
+                total -= entry["size"]
+        if evicted:
+            logger.info("Retention evicted %d uploads", len(evicted))
+        return evicted
+
+    def trigger(self) -> None:
+        # ask the compactor to run soon, e.g. right after a save
+        self._wake.set()
+
+    def start(self) -> None:
+        # a thread object inherited across fork() is no longer alive
+        if not self.enabled or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.enforce()
+            except Exception:
+                logger.exception("Retention pass failed")
+            self._wake.wait(self.interval)
+            self._wake.clear()
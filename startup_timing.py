@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Opt-in startup timing, enabled with ``STARTUP_TIMING=1``.
+
+On a Pi Zero every hundred milliseconds before the IP splash appears is
+noticeable. This module has to be imported before anything heavy. When it is
+enabled, it wraps ``__import__`` to time each top-level package the first
+time it is loaded (including its dependencies), and ``mark()`` records named
+phases. ``report()`` prints both to stderr, slowest imports first. When it is
+disabled, every function here is a no-op.
+
+The switch is read before ``load_dotenv()`` has run, so this module reads
+``STARTUP_TIMING`` from the ``.env`` next to it itself, without importing
+python-dotenv (that import would be the first thing it times).
+"""
+
+import builtins, os, sys, time
+
+
+def _setting(name: str) -> str:
+    # the process environment wins, as with load_dotenv()
+    if name in os.environ:
+        return os.environ[name]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+    try:
+        with open(path, encoding="utf-8") as fh:
+            for line in fh:
+                key, sep, value = line.strip().removeprefix("export ").partition("=")
+                if sep and key.strip() == name:
+                    return value.split(" #", 1)[0].strip().strip("'\"")
+    except OSError:
+        pass
+    return ""
+
+
+ENABLED = _setting("STARTUP_TIMING").lower() not in ("", "0", "false", "no")
+
+_started = time.perf_counter()
+_last = _started
+_marks = []
+_imports = {}
+_depth = 0
+_original_import = builtins.__import__
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    global _depth
+    top = name.partition(".")[0]
+    if _depth or level or not top or top in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    # outermost import of a package not loaded yet: its time includes
+    # everything it pulls in, attributed to the name the app asked for
+    _depth += 1
+    began = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _depth -= 1
+        _imports[top] = _imports.get(top, 0.0) + time.perf_counter() - began
+
+
+def install() -> None:
+    if ENABLED and builtins.__import__ is _original_import:
+        builtins.__import__ = _timed_import
+
+
+def mark(label: str) -> None:
+    global _last
+    if not ENABLED:
+        return
+    now = time.perf_counter()
+    _marks.append((label, now - _last, now - _started))
+    _last = now
+
+
+def report(limit: int = 15) -> None:
+    # print what was measured since the last report; imports are only
+    # listed once, the first time (the hook is removed at that point)
+    if not ENABLED:
+        return
+    out = sys.stderr
+    if builtins.__import__ is _timed_import:
+        builtins.__import__ = _original_import
+        ranked = sorted(_imports.items(), key=lambda item: item[1], reverse=True)
+        print("startup: slowest imports (inclusive)", file=out)
+        for name, seconds in ranked[:limit]:
+            print(f"  {seconds * 1000:8.1f} ms  {name}", file=out)
+    print("startup: phases", file=out)
+    for label, seconds, total in _marks:
+        print(f"  {seconds * 1000:8.1f} ms  (at {total * 1000:8.1f} ms)  {label}", file=out)
+    _marks.clear()
+    out.flush()
+
+
+install()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""On-disk encoding for generated images.
+
+AI output is photographic, so PNG is both slow to encode on a Pi and large.
+The codec is chosen per install (``GEN_STORAGE_FORMAT``); everything that
+reads images goes through ``Image.open`` and the browser, both of which
+understand every format offered here, so decoding needs no special casing.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# name -> file extension
+CODECS = {
+    "png": ".png",
+    "webp-lossless": ".webp",
+    "webp": ".webp",
+    "jpeg": ".jpg",
+}
+# other spellings of the extensions above: a ".jpeg" file already is a JPEG
+EXTENSION_ALIASES = {".jpeg": ".jpg", ".jpe": ".jpg"}
+
+
+def normalize_ext(ext: str) -> str:
+    ext = ext.lower()
+    return EXTENSION_ALIASES.get(ext, ext)
+
+
+class StorageCodec:
+    def __init__(self, name: str = "png", *, quality: int = 90,
+                 png_compress_level: int = 6):
+        name = (name or "png").strip().lower()
+        if name not in CODECS:
+            logger.warning("Unknown storage format %s, using png", name)
+            name = "png"
+        self.name = name
+        self.quality = max(1, min(quality, 100))
+        self.png_compress_level = max(0, min(png_compress_level, 9))
+
+    @property
+    def ext(self) -> str:
+        return CODECS[self.name]
+
+    def save_options(self) -> dict:
+        if self.name == "png":
+            return {"format": "PNG", "compress_level": self.png_compress_level}
+        if self.name == "webp-lossless":
+            # quality is the compression effort for lossless WebP
+            return {"format": "WEBP", "lossless": True, "quality": self.quality, "method": 4}
+        if self.name == "webp":
+            return {"format": "WEBP", "quality": self.quality, "method": 4}
+        return {"format": "JPEG", "quality": self.quality, "subsampling": 0}
+
+    def save(self, img, fp) -> None:
+        options = self.save_options()
+        if options["format"] == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        elif img.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+            img = img.convert("RGB")
+        img.save(fp, **options)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Scriptable stand-in for the Hugging Face inference API.
+
+    python3 tests/stub_inference.py [--port 8765] [--fail MODEL=503 ...]
+
+Point the app at it with ``HF_BASE_URL=http://127.0.0.1:8765``. Every
+``POST /models/<model id>`` returns a small PNG unless a failure was
+scripted for that model. Tests script responses per call with ``script()``.
+From the command line, ``--fail`` makes every call to a model fail.
+"""
+
+import argparse, collections, sys, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image
+
+
+def _png() -> bytes:
+    out = BytesIO()
+    Image.new("RGB", (8, 8), (255, 255, 255)).save(out, "PNG")
+    return out.getvalue()
+
+
+class StubInference(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int = 0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.image = _png()
+        self.calls = []                                 # model ids, in arrival order
+        self.always = {}                                # model -> (status, headers)
+        self._scripts = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def script(self, model: str, *responses) -> None:
+        # responses are consumed one per call: "ok", or (status, headers dict)
+        with self._lock:
+            self._scripts[model].extend(responses)
+
+    def next_response(self, model: str):
+        with self._lock:
+            self.calls.append(model)
+            if self._scripts[model]:
+                return self._scripts[model].popleft()
+            return self.always.get(model, "ok")
+
+    def start(self) -> "StubInference":
+        threading.Thread(target=self.serve_forever, name="stub-inference", daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if not self.path.startswith("/models/"):
+            self.send_error(404)
+            return
+        response = self.server.next_response(self.path[len("/models/"):])
+        if response == "ok":
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(self.server.image)))
+            self.end_headers()
+            self.wfile.write(self.server.image)
+            return
+        status, headers = response
+        body = b'{"error": "stubbed failure"}'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, str(value))
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fail", action="append", default=[], metavar="MODEL=STATUS",
+                        help="answer every call to MODEL with STATUS (e.g. 503)")
+    args = parser.parse_args(argv)
+    server = StubInference(args.port)
+    for rule in args.fail:
+        model, _, status = rule.partition("=")
+        server.always[model] = (int(status or 503), {})
+    print(f"Stub inference API on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,28 @@
+import threading
+
+from events import EventBus
+
+
+def test_streams_see_events_published_by_another_process(tmp_path):
+    db = str(tmp_path / "activity.db")
+    worker, other = EventBus(db, poll=0.05), EventBus(db, poll=0.05)
+    since = other.last_id()
+    stream = other.stream(since, heartbeat=5)
+    threading.Timer(0.1, worker.publish, args=("job", "display", "converting")).start()
+    event = next(stream)
+    assert (event["job"], event["stage"]) == ("job", "converting")
+    assert [job["stage"] for job in other.active()] == ["converting"]
+    worker.publish("job", "display", "done")
+    assert next(stream)["stage"] == "done"
+    assert other.active() == []
+
+
+def test_event_ids_keep_counting_after_a_restart(tmp_path):
+    db = str(tmp_path / "activity.db")
+    first = EventBus(db, keep=2).publish("a", "display", "decoding")["id"]
+    for _ in range(3):
+        EventBus(db, keep=2).publish("a", "display", "converting")
+    restarted = EventBus(db, keep=2)
+    assert restarted.publish("b", "display", "decoding")["id"] == first + 4
+    assert restarted.last_id() == first + 4
+    assert [event["id"] for event in restarted._since(0)] == [first + 3, first + 4]
@@ -0,0 +1,65 @@
+import threading, time
+
+from generation import GenerationService, JobStore
+
+
+def test_fallback_waits_for_the_fallback_models_slot():
+    release = threading.Event()
+    order = []
+
+    def run(job):
+        if job.model == "x":
+            order.append("x started")
+            release.wait(5)
+            order.append("x finished")
+        else:
+            service.use_model(job, "x")     # y failed over to x
+            order.append("y running on x")
+        return {}
+
+    service = GenerationService(run, workers=3, per_model=1)
+    first = service.submit("x", {})
+    second = service.submit("y", {})
+    time.sleep(0.2)
+    third = service.submit("y", {})
+    try:
+        assert order == ["x started"]           # x's only slot is taken
+        assert third.status == "running"       # second gave up its y slot
+    finally:
+        release.set()
+    done = list(service.as_completed([first, second, third], timeout=5))
+    assert len(done) == 3
+    assert order == ["x started", "x finished", "y running on x", "y running on x"]
+    assert all(count == 0 for count in service._running.values())
+
+
+def test_use_model_is_a_no_op_for_the_jobs_own_model():
+    def run(job):
+        service.use_model(job, job.model)
+        return {"ok": True}
+
+    service = GenerationService(run, workers=1, per_model=1)
+    job = service.submit("x", {})
+    assert list(service.as_completed([job], timeout=5))[0].result == {"ok": True}
+    assert service._running["x"] == 0
+
+
+def test_status_comes_from_the_shared_store_in_another_process(tmp_path):
+    db = str(tmp_path / "generation.db")
+    service = GenerationService(lambda job: {"filename": "a.png"}, store=JobStore(db))
+    job = service.submit("m", {})
+    assert list(service.as_completed([job], timeout=5)) == [job]
+    other = GenerationService(lambda job: {}, store=JobStore(db))   # another worker
+    status = other.status(job.id)
+    assert status["status"] == "done"
+    assert status["result"] == {"filename": "a.png"}
+    assert other.status("missing") is None
+
+
+def test_job_store_keeps_the_newest_finished_jobs(tmp_path):
+    store = JobStore(str(tmp_path / "generation.db"), keep=2)
+    for n in range(4):
+        store.save({"id": f"job{n}", "status": "done"})
+        time.sleep(0.01)
+    assert store.get("job0") is None and store.get("job1") is None
+    assert store.get("job3")["status"] == "done"
@@ -0,0 +1,206 @@
+import socket
+
+import pytest
+
+import inference
+from inference import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, ModelUnavailable, ResilientInference
+from stub_inference import StubInference
+
+
+class _Response:
+    def __init__(self, status, headers=None):
+        self.status_code = status
+        self.headers = headers or {}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, headers=None):
+        super().__init__(f"HTTP {status}")
+        self.response = _Response(status, headers)
+
+
+def _transport_error(module, *names):
+    # a stand-in class hierarchy named like the real library's
+    base = Exception
+    for name in names:
+        base = type(name, (base,), {"__module__": module})
+    return base
+
+
+def scripted(outcomes):
+    # attempt() that raises or returns the next outcome for each model
+    calls = []
+
+    def attempt(model):
+        calls.append(model)
+        outcome = outcomes[model].pop(0) if isinstance(outcomes[model], list) else outcomes[model]
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+    return attempt, calls
+
+
+def resilient(**kwargs):
+    sleeps = []
+    kwargs.setdefault("sleep", sleeps.append)
+    return ResilientInference(**kwargs), sleeps
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(inference.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_transient_errors_are_retried_until_success():
+    client, sleeps = resilient(retries=2, backoff=0.01)
+    attempt, calls = scripted({"a": [HTTPError(503), HTTPError(429), "image"]})
+    assert client.call(["a"], attempt) == ("image", "a")
+    assert calls == ["a", "a", "a"]
+    assert len(sleeps) == 2
+
+
+def test_retry_budget_is_retries_plus_one_attempts():
+    client, sleeps = resilient(retries=2, backoff=0.01)
+    attempt, calls = scripted({"a": HTTPError(503)})
+    with pytest.raises(ModelUnavailable):
+        client.call(["a"], attempt)
+    assert calls == ["a"] * 3
+    assert len(sleeps) == 2     # no pointless sleep after the last attempt
+
+
+def test_non_transient_errors_are_not_retried():
+    client, sleeps = resilient(retries=3)
+    attempt, calls = scripted({"a": HTTPError(400), "b": "image"})
+    with pytest.raises(HTTPError):
+        client.call(["a", "b"], attempt)
+    assert calls == ["a"]
+    assert sleeps == []
+    assert client.breaker("a").state == CLOSED
+
+
+def test_retry_after_is_honoured_up_to_the_backoff_cap():
+    client, sleeps = resilient(retries=1, backoff=0.001, max_backoff=20)
+    attempt, _ = scripted({"a": [HTTPError(503, {"Retry-After": "7"}), "image"]})
+    client.call(["a"], attempt)
+    assert 7 <= sleeps[0] <= 20
+
+    client, sleeps = resilient(retries=1, backoff=0.001, max_backoff=20)
+    attempt, _ = scripted({"a": [HTTPError(503, {"Retry-After": "600"}), "image"]})
+    client.call(["a"], attempt)
+    assert sleeps == [20]
+
+
+@pytest.mark.parametrize("exc", [
+    ConnectionResetError("reset"),
+    TimeoutError("slow"),
+    _transport_error("httpx", "TransportError", "NetworkError", "ConnectError")("refused"),
+    _transport_error("httpx", "TransportError", "ProtocolError", "RemoteProtocolError")("eof"),
+    _transport_error("httpx", "TransportError", "TimeoutException", "ReadTimeout")("slow"),
+    _transport_error("requests.exceptions", "RequestException", "ConnectionError")("refused"),
+    _transport_error("requests.exceptions", "RequestException", "ChunkedEncodingError")("cut"),
+])
+def test_transport_failures_are_transient(exc):
+    assert inference.is_transient(exc)
+
+
+@pytest.mark.parametrize("exc", [
+    ValueError("bad"),
+    HTTPError(400),
+    HTTPError(401),
+    _transport_error("httpx", "TransportError", "UnsupportedProtocol")("ftp://"),
+])
+def test_client_errors_are_not_transient(exc):
+    assert not inference.is_transient(exc)
+
+
+def test_breaker_opens_half_opens_and_closes(clock):
+    breaker = CircuitBreaker(failures=2, reset_after=60)
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+    clock[0] += 60
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()          # one trial call
+    assert not breaker.allow()
+    breaker.record_failure()        # the trial failed: open again
+    assert breaker.state == OPEN
+
+    clock[0] += 60
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+def test_fallback_follows_model_order_and_skips_open_circuits(clock):
+    client, _ = resilient(retries=1, backoff=0.001, breaker_failures=1, breaker_reset=60)
+    attempt, calls = scripted({"a": HTTPError(503), "b": HTTPError(502), "c": "image"})
+    switched = []
+    assert client.call(["a", "b", "c"], attempt, switch=switched.append) == ("image", "c")
+    assert calls == ["a", "a", "b", "b", "c"]
+    assert switched == ["a", "b", "c"]
+
+    calls.clear()
+    assert client.call(["a", "b", "c"], attempt) == ("image", "c")
+    assert calls == ["c"]           # a and b are open now
+    assert client.states() == {"a": OPEN, "b": OPEN, "c": CLOSED}
+
+    clock[0] += 60                  # a gets its trial call again
+    attempt, calls = scripted({"a": "image", "b": "image", "c": "image"})
+    assert client.call(["a", "b", "c"], attempt) == ("image", "a")
+    assert client.breaker("a").state == CLOSED
+
+
+def test_all_circuits_open_fails_fast():
+    client, _ = resilient(retries=0, breaker_failures=1)
+    attempt, calls = scripted({"a": HTTPError(503)})
+    with pytest.raises(ModelUnavailable):
+        client.call(["a"], attempt)
+    with pytest.raises(ModelUnavailable, match="temporarily unavailable"):
+        client.call(["a"], attempt)
+    assert calls == ["a"]
+
+
+# -- against the stub server, through the real client ------------------------
+
+@pytest.fixture
+def stub():
+    server = StubInference().start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def hf_client():
+    hub = pytest.importorskip("huggingface_hub")
+    return hub.InferenceClient(provider="hf-inference", api_key="test", timeout=10)
+
+
+def test_stub_cold_model_falls_back_after_retry_after(stub, hf_client):
+    stub.always["cold"] = (503, {"Retry-After": "2"})
+    client, sleeps = resilient(retries=1, backoff=0.001, breaker_failures=1)
+    result, model = client.call(
+        ["cold", "warm"],
+        lambda m: hf_client.text_to_image("a lighthouse", model=f"{stub.url}/models/{m}"),
+    )
+    assert model == "warm"
+    assert result.size == (8, 8)
+    assert stub.calls == ["cold", "cold", "warm"]
+    assert sleeps and sleeps[0] >= 2
+
+
+def test_stub_dropped_connections_are_retried(hf_client):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]    # closed again: nothing listens there
+    client, sleeps = resilient(retries=2, backoff=0.001)
+    with pytest.raises(ModelUnavailable):
+        client.call(["gone"], lambda m: hf_client.text_to_image(
+            "a lighthouse", model=f"http://127.0.0.1:{port}/models/{m}"))
+    assert len(sleeps) == 2
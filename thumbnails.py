@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Small preview images for the uploads gallery.
+
+Thumbnails live in their own cache directory, named after the content hash
+of the source image (or its filename before it has been hashed), so
+duplicate uploads share one preview and everything can be dropped and
+regenerated at any time. The cache is trimmed
+least-recently-used first once it grows past ``max_bytes``; serving a
+thumbnail touches its mtime, which is what the LRU order uses.
+"""
+
+import hashlib, logging, os, threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, features
+
+logger = logging.getLogger(__name__)
+
+
+class ThumbnailCache:
+    def __init__(self, source_folder: str, cache_dir: str, *, size: int = 320,
+                 max_bytes: int = 64 * 1024 * 1024, quality: int = 70):
+        self.source_folder = source_folder
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.size = (size, size)
+        self.max_bytes = max_bytes
+        self.quality = quality
+        if features.check("webp"):
+            self.format, self.ext, self.mimetype = "WEBP", ".webp", "image/webp"
+        else:
+            self.format, self.ext, self.mimetype = "JPEG", ".jpg", "image/jpeg"
+        self._lock = threading.Lock()
+        self._etags = {}
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="thumbs")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + self.ext)
+
+    def _is_fresh(self, thumb: str, source: str) -> bool:
+        try:
+            return os.stat(thumb).st_mtime_ns >= os.stat(source).st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+    def ensure(self, filename: str, key=None) -> str:
+        # return a current thumbnail, building it first if missing or stale
+        source = os.path.join(self.source_folder, filename)
+        thumb = self.path_for(key or filename)
+        if self._is_fresh(thumb, source):
+            try:
+                os.utime(thumb)
+            except OSError:
+                pass
+            return thumb
+        return self.build(filename, key)
+
+    def build(self, filename: str, key=None) -> str:
+        source = os.path.join(self.source_folder, filename)
+        thumb = self.path_for(key or filename)
+        with Image.open(source) as img:
+            # let the JPEG decoder downscale while decoding
+            img.draft("RGB", self.size)
+            img = img.convert("RGB")
+            img.thumbnail(self.size)
+            tmp = f"{thumb}.{threading.get_ident()}.tmp"
+            img.save(tmp, self.format, quality=self.quality)
+        os.replace(tmp, thumb)
+        with self._lock:
+            self._etags.pop(thumb, None)
+        self.prune()
+        return thumb
+
+    def schedule(self, filename: str, key=None) -> None:
+        # build in the background so saving an upload doesn't wait on Pillow
+        def _run():
+            try:
+                self.ensure(filename, key)
+            except FileNotFoundError:
+                pass  # deleted before we got to it
+            except Exception:
+                logger.exception("Thumbnail generation failed for %s", filename)
+        self._pool.submit(_run)
+
+    def schedule_batch(self, items, workers=None) -> None:
+        # bulk imports: build (filename, key) pairs on a temporary pool sized
+        # to the CPU count; Pillow releases the GIL while decoding/resizing
+        items = list(items)
+        if not items:
+            return
+        workers = workers or os.cpu_count() or 1
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbs-batch")
+
+        def _one(item):
+            try:
+                self.ensure(*item)
+            except FileNotFoundError:
+                pass
+            except Exception:
+                logger.exception("Thumbnail generation failed for %s", item[0])
+
+        for item in items:
+            pool.submit(_one, item)
+        pool.shutdown(wait=False)
+
+    def etag(self, thumb: str) -> str:
+        # strong validator: hash of the thumbnail bytes. Rebuilds replace the
+        # file (new inode), so the inode identifies the content we hashed.
+        stat = os.stat(thumb)
+        key = (stat.st_ino, stat.st_size)
+        with self._lock:
+            cached = self._etags.get(thumb)
+            if cached and cached[0] == key:
+                return cached[1]
+        with open(thumb, "rb") as fh:
+            digest = hashlib.sha1(fh.read()).hexdigest()
+        with self._lock:
+            self._etags[thumb] = (key, digest)
+        return digest
+
+    def discard(self, key: str) -> None:
+        thumb = self.path_for(key)
+        with self._lock:
+            self._etags.pop(thumb, None)
+        try:
+            os.remove(thumb)
+        except FileNotFoundError:
+            pass
+
+    def prune(self) -> None:
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file() or entry.name.endswith(".tmp"):
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self._lock:
+                self._etags.pop(path, None)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Lightweight per-job tracing for display updates and generations.
+
+A trace covers one job. The spans inside it (Pillow stages in app.py, driver
+calls such as ``init``/``getbuffer``/``display``/``TurnOnDisplay``/``sleep``)
+record their start offset and duration. When a display update takes 90 s
+instead of 30 s, the trace shows whether Pillow, SPI or the panel took the
+time. The last ``keep`` finished traces are kept in a SQLite table shared by
+every process of the app, so ``/traces`` on any gunicorn worker lists them
+all. Traces slower than their kind's threshold are also written to the
+slow-job log.
+
+Spans attach to the trace running on the current thread. A span opened
+outside any trace costs one thread-local lookup and records nothing.
+"""
+
+import json, logging, sqlite3, threading, time, uuid
+from contextlib import contextmanager
+
+from lazy_sqlite import LazySqlite
+
+logger = logging.getLogger(__name__)
+
+
+class Trace:
+    def __init__(self, kind: str, job=None, **attrs):
+        self.id = job or uuid.uuid4().hex
+        self.kind = kind
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.began = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self.spans = []
+        self._stack = []
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "attrs": self.attrs,
+            "started_at": self.started_at,
+            "duration_ms": None if self.duration is None else round(self.duration * 1000, 1),
+            "error": self.error,
+            "spans": self.spans,
+        }
+
+
+class Tracer(LazySqlite):
+    def __init__(self, db_path: str, *, keep: int = 50, slow=None, slow_logger=None,
+                 max_spans: int = 500):
+        # slow: {kind: seconds}; traces of that kind taking longer are logged
+        super().__init__(db_path)
+        self.keep = keep
+        self.slow = dict(slow or {})
+        self.slow_logger = slow_logger or logger
+        self.max_spans = max_spans
+        self._local = threading.local()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS traces ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT NOT NULL, kind TEXT NOT NULL,"
+            " slow INTEGER NOT NULL, body TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS traces_id ON traces (id)")
+
+    def _configure(self, db) -> None:
+        db.execute("PRAGMA synchronous=NORMAL")
+
+    def current(self):
+        return getattr(self._local, "trace", None)
+
+    @contextmanager
+    def trace(self, kind: str, job=None, **attrs):
+        outer = self.current()
+        if outer is not None:
+            # nested job (e.g. a display started from a generation): fold it in
+            with self.span(kind, **attrs):
+                yield outer
+            return
+        trace = Trace(kind, job, **attrs)
+        self._local.trace = trace
+        try:
+            yield trace
+        except BaseException as exc:
+            trace.error = f"{type(exc).__name__}: {exc}"
+            raise
+        finally:
+            self._local.trace = None
+            trace.duration = time.perf_counter() - trace.began
+            self._store(trace)
+            self._check_slow(trace)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        trace = self.current()
+        if trace is None or len(trace.spans) >= self.max_spans:
+            yield
+            return
+        began = time.perf_counter()
+        record = {
+            "name": name,
+            "depth": len(trace._stack),
+            "start_ms": round((began - trace.began) * 1000, 1),
+            "duration_ms": None,
+        }
+        if attrs:
+            record["attrs"] = attrs
+        trace.spans.append(record)
+        trace._stack.append(record)
+        try:
+            yield
+        except BaseException as exc:
+            record["error"] = type(exc).__name__
+            raise
+        finally:
+            trace._stack.pop()
+            record["duration_ms"] = round((time.perf_counter() - began) * 1000, 1)
+
+    def _is_slow(self, trace: Trace) -> bool:
+        threshold = self.slow.get(trace.kind)
+        return bool(threshold) and trace.duration >= threshold
+
+    def _store(self, trace: Trace) -> None:
+        try:
+            with self._lock, self._conn as db:
+                cur = db.execute(
+                    "INSERT INTO traces (id, kind, slow, body) VALUES (?, ?, ?, ?)",
+                    (trace.id, trace.kind, int(self._is_slow(trace)),
+                     json.dumps(trace.to_dict(), default=str)),
+                )
+                db.execute("DELETE FROM traces WHERE seq <= ?", (cur.lastrowid - self.keep,))
+        except sqlite3.Error:
+            logger.exception("Could not store trace %s", trace.id)
+
+    def _check_slow(self, trace: Trace) -> None:
+        if not self._is_slow(trace):
+            return
+        threshold = self.slow[trace.kind]
+        # top-level spans are the readable summary; the full trace follows
+        summary = ", ".join(
+            f"{span['name']}={span['duration_ms']:.0f}ms"
+            for span in trace.spans if span["depth"] == 0 and span["duration_ms"] is not None
+        )
+        self.slow_logger.warning(
+            "Slow %s job %s: %.1fs (threshold %gs): %s\n%s",
+            trace.kind, trace.id, trace.duration, threshold, summary,
+            json.dumps(trace.to_dict()),
+        )
+
+    def recent(self, *, kind=None, slow_only=False, limit=None) -> list:
+        # newest first
+        clauses, params = ["1"], []
+        if kind:
+            clauses.append("kind = ?")
+            params.append(kind)
+        if slow_only:
+            clauses.append("slow = 1")
+        sql = "SELECT body FROM traces WHERE " + " AND ".join(clauses) + " ORDER BY seq DESC"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [json.loads(body) for (body,) in rows]
+
+    def get(self, trace_id: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body FROM traces WHERE id = ? ORDER BY seq DESC LIMIT 1", (trace_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
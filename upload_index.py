@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""SQLite metadata index for the uploads folder.
+
+Every saved image gets a row (source, model, preset, size, ...) so the web UI
+can page through the library and fetch only what changed instead of listing
+the whole directory. Deletions are kept as tombstones with their own sequence
+number, which is what makes the incremental ``changes_since`` query work.
+"""
+
+import os, re, sqlite3, time
+from contextlib import contextmanager
+from lazy_sqlite import LazySqlite
+
+SOURCES = ("upload", "generated")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    filename   TEXT PRIMARY KEY,
+    source     TEXT NOT NULL,
+    model      TEXT,
+    preset     TEXT,
+    subject    TEXT,
+    size       INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    sha256     TEXT,
+    pinned     INTEGER NOT NULL DEFAULT 0,
+    last_displayed REAL,
+    seq        INTEGER NOT NULL,
+    deleted    INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS uploads_seq ON uploads (seq);
+CREATE INDEX IF NOT EXISTS uploads_source ON uploads (source, filename);
+"""
+
+_COLUMNS = (
+    "filename", "source", "model", "preset", "subject", "size", "created_at",
+    "sha256", "pinned", "last_displayed",
+)
+# added after the first release; created on open for older databases
+_LATE_COLUMNS = {
+    "sha256": "TEXT",
+    "pinned": "INTEGER NOT NULL DEFAULT 0",
+    "last_displayed": "REAL",
+}
+
+_INSERT = (
+    "INSERT OR REPLACE INTO uploads "
+    "(filename, source, model, preset, subject, size, created_at, sha256, seq, deleted) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)"
+)
+
+_UPLOAD_RE = re.compile(r"^\d{8}-\d{6}_")
+_GENERATED_RE = re.compile(r"^\d{8}-\d{6}-")
+
+
+def guess_metadata(filename: str, chip_labels=()) -> dict:
+    # best effort for files that predate the index (or were copied in by hand)
+    if _GENERATED_RE.match(filename) and not _UPLOAD_RE.match(filename):
+        stem = os.path.splitext(filename)[0]
+        last = stem.rsplit("-", 1)[-1]
+        preset = last if last in chip_labels or last == "custom" else None
+        return {"source": "generated", "preset": preset}
+    return {"source": "upload"}
+
+
+class UploadIndex(LazySqlite):
+    def __init__(self, db_path: str, folder: str):
+        super().__init__(db_path, row_factory=sqlite3.Row)
+        self.folder = folder
+        self._conn.executescript(_SCHEMA)
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(uploads)")}
+        for column, decl in _LATE_COLUMNS.items():
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE uploads ADD COLUMN {column} {decl}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS uploads_sha256 ON uploads (sha256)")
+
+    # -- writes --------------------------------------------------------------
+
+    @contextmanager
+    def _write(self):
+        # A change that takes a new seq. BEGIN IMMEDIATE takes SQLite's write
+        # lock before _next_seq() reads MAX(seq), so two processes sharing
+        # the database can never hand out the same number.
+        with self._lock, self._conn as db:
+            db.execute("BEGIN IMMEDIATE")
+            yield db
+
+    def _next_seq(self) -> int:
+        row = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM uploads").fetchone()
+        return row[0] + 1
+
+    def add(self, filename: str, source: str = "upload", *, model=None,
+            preset=None, subject=None, size=None, created_at=None,
+            sha256=None) -> dict:
+        if source not in SOURCES:
+            raise ValueError(f"Unknown source {source!r}")
+        if size is None:
+            try:
+                size = os.path.getsize(os.path.join(self.folder, filename))
+            except OSError:
+                size = 0
+        created_at = created_at if created_at is not None else time.time()
+        with self._write():
+            seq = self._next_seq()
+            self._conn.execute(
+                _INSERT, (filename, source, model, preset, subject, size, created_at, sha256, seq)
+            )
+        return self.get(filename)
+
+    def remove(self, filename: str) -> bool:
+        with self._write():
+            seq = self._next_seq()
+            cur = self._conn.execute(
+                "UPDATE uploads SET deleted = 1, seq = ? WHERE filename = ? AND deleted = 0",
+                (seq, filename),
+            )
+        return cur.rowcount > 0
+
+    def set_hash(self, filename: str, sha256: str) -> None:
+        # metadata only, so it does not count as a change for listeners
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE uploads SET sha256 = ? WHERE filename = ?", (sha256, filename)
+            )
+
+    def set_pinned(self, filename: str, pinned: bool) -> bool:
+        with self._write():
+            seq = self._next_seq()
+            cur = self._conn.execute(
+                "UPDATE uploads SET pinned = ?, seq = ? WHERE filename = ? AND deleted = 0",
+                (int(bool(pinned)), seq, filename),
+            )
+        return cur.rowcount > 0
+
+    def mark_displayed(self, filename: str, when=None) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE uploads SET last_displayed = ? WHERE filename = ?",
+                (when if when is not None else time.time(), filename),
+            )
+
+    def sync(self, chip_labels=(), *, reserved_ttl=None) -> None:
+        # Reconcile with the folder: index new files, tombstone vanished ones.
+        # Empty files are names reserved by a save in progress; with
+        # reserved_ttl, ones older than that many seconds were left by a save
+        # that crashed and are deleted so their names are free again.
+        try:
+            on_disk = {
+                entry.name: entry.stat()
+                for entry in os.scandir(self.folder)
+                if entry.is_file() and not entry.name.startswith(".")
+            }
+        except FileNotFoundError:
+            on_disk = {}
+        if reserved_ttl is not None:
+            cutoff = time.time() - reserved_ttl
+            for name, stat in list(on_disk.items()):
+                if stat.st_size == 0 and stat.st_mtime < cutoff:
+                    try:
+                        os.remove(os.path.join(self.folder, name))
+                    except FileNotFoundError:
+                        pass
+                    del on_disk[name]
+        # one transaction (one fsync) for the lot: this runs at boot, and a
+        # library of legacy files would otherwise cost a commit per file
+        with self._write() as db:
+            known = {
+                row["filename"]
+                for row in db.execute("SELECT filename FROM uploads WHERE deleted = 0")
+            }
+            seq = self._next_seq()
+            for name in sorted(set(on_disk) - known):
+                stat = on_disk[name]
+                if stat.st_size == 0:
+                    continue  # name reserved by a save that never finished
+                meta = guess_metadata(name, chip_labels)
+                db.execute(_INSERT, (name, meta["source"], None, meta.get("preset"), None,
+                                     stat.st_size, stat.st_mtime, None, seq))
+                seq += 1
+            for name in sorted(known - set(on_disk)):
+                db.execute(
+                    "UPDATE uploads SET deleted = 1, seq = ? WHERE filename = ? AND deleted = 0",
+                    (seq, name),
+                )
+                seq += 1
+
+    # -- reads ---------------------------------------------------------------
+
+    @staticmethod
+    def _row(row) -> dict:
+        entry = {key: row[key] for key in _COLUMNS}
+        entry["pinned"] = bool(entry["pinned"])
+        return entry
+
+    def get(self, filename: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM uploads WHERE filename = ? AND deleted = 0", (filename,)
+            ).fetchone()
+        return self._row(row) if row else None
+
+    def names_for_hash(self, sha256: str) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT filename FROM uploads WHERE sha256 = ? AND deleted = 0", (sha256,)
+            ).fetchall()
+        return [row["filename"] for row in rows]
+
+    def unhashed(self, limit: int = 100) -> list:
+        # entries indexed from disk whose content has not been hashed yet
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT filename FROM uploads WHERE sha256 IS NULL AND deleted = 0 LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [row["filename"] for row in rows]
+
+    def usage(self):
+        # (live entries, bytes on disk); duplicates share one blob
+        with self._lock:
+            count = self._conn.execute(
+                "SELECT COUNT(*) FROM uploads WHERE deleted = 0"
+            ).fetchone()[0]
+            total = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM ("
+                " SELECT MAX(size) AS size FROM uploads WHERE deleted = 0"
+                " GROUP BY COALESCE(sha256, filename))"
+            ).fetchone()[0]
+        return count, total
+
+    def eviction_candidates(self) -> list:
+        # unpinned entries, least recently displayed (or created) first
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM uploads WHERE deleted = 0 AND pinned = 0"
+                " ORDER BY COALESCE(last_displayed, created_at), filename"
+            ).fetchall()
+        return [self._row(row) for row in rows]
+
+    def page(self, *, limit: int = 100, cursor=None, source=None, model=None,
+             preset=None) -> dict:
+        # newest first; timestamped names sort chronologically, so the last
+        # filename of a page is a stable cursor for the next one
+        clauses, params = ["deleted = 0"], []
+        if cursor:
+            clauses.append("filename < ?")
+            params.append(cursor)
+        for column, value in (("source", source), ("model", model), ("preset", preset)):
+            if value:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        sql = (
+            "SELECT * FROM uploads WHERE " + " AND ".join(clauses)
+            + " ORDER BY filename DESC LIMIT ?"
+        )
+        with self._lock:
+            rows = self._conn.execute(sql, params + [limit + 1]).fetchall()
+            seq = self._next_seq() - 1
+        items = [self._row(row) for row in rows[:limit]]
+        next_cursor = items[-1]["filename"] if len(rows) > limit else None
+        return {"items": items, "next_cursor": next_cursor, "seq": seq}
+
+    def changes_since(self, since: int, limit: int = 500) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM uploads WHERE seq > ? ORDER BY seq LIMIT ?",
+                (since, limit + 1),
+            ).fetchall()
+            seq = self._next_seq() - 1
+        changes = []
+        for row in rows[:limit]:
+            entry = self._row(row)
+            entry["deleted"] = bool(row["deleted"])
+            changes.append(entry)
+        # when truncated, resume from the last change returned
+        if len(rows) > limit:
+            seq = rows[limit - 1]["seq"]
+        return {"changes": changes, "seq": seq, "more": len(rows) > limit}
@@ -30,6 +30,7 @@
 
 import logging
 from . import epdconfig
+from . import orientation
 
 # Display resolution
 EPD_WIDTH       = 122
@@ -251,7 +252,7 @@ class EPD:
             img = img.convert('1')
         elif(imwidth == self.height and imheight == self.width):
             # image has correct dimensions, but needs to be rotated
-            img = img.rotate(90, expand=True).convert('1')
+            img = orientation.portrait_to_native(img).convert('1')
         else:
             logger.warning("Wrong image dimensions: must be " + str(self.width) + "x" + str(self.height))
             # return a blank buffer
@@ -30,6 +30,8 @@
 
 import logging
 from . import epdconfig
+from . import orientation
+from . import palette
 
 import PIL
 from PIL import Image
@@ -42,6 +44,11 @@ EPD_HEIGHT      = 360
 logger = logging.getLogger(__name__)
 
 class EPD:
+    # RGB colours the panel can show, indexed by the colour code getbuffer()
+    # emits. Shared by all instances so callers can preview the exact output.
+    PALETTE = ((0, 0, 0), (255, 255, 255), (255, 255, 0), (255, 0, 0))
+    PALETTE_IMAGE = palette.palette_image(PALETTE)
+
     def __init__(self):
         self.reset_pin = epdconfig.RST_PIN
         self.dc_pin = epdconfig.DC_PIN
@@ -159,16 +166,15 @@ class EPD:
         return 0
 
     def getbuffer(self, image):
-        # Create a pallette with the 4 colors supported by the panel
-        pal_image = Image.new("P", (1,1))
-        pal_image.putpalette( (0,0,0,  255,255,255,  255,255,0,   255,0,0) + (0,0,0)*252)
+        # Palette with the 4 colors supported by the panel, built once per class
+        pal_image = self.PALETTE_IMAGE
 
         # Check if we need to rotate the image
         imwidth, imheight = image.size
         if(imwidth == self.width and imheight == self.height):
             image_temp = image
         elif(imwidth == self.height and imheight == self.width):
-            image_temp = image.rotate(90, expand=True)
+            image_temp = orientation.portrait_to_native(image)
         else:
             logger.warning("Invalid image dimensions: %d x %d, expected %d x %d" % (imwidth, imheight, self.width, self.height))
 
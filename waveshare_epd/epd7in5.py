@@ -30,6 +30,7 @@
 
 import logging
 from . import epdconfig
+from . import orientation
 
 # Display resolution
 EPD_WIDTH       = 640
@@ -133,7 +134,7 @@ class EPD:
         if(imwidth == self.width and imheight == self.height):
             img = img.convert('1')
         elif(imwidth == self.height and imheight == self.width):
-            img = img.rotate(90, expand=True).convert('1')
+            img = orientation.portrait_to_native(img).convert('1')
             imwidth, imheight = img.size
         else:
             logger.warning("Wrong image dimensions: must be " + str(self.width) + "x" + str(self.height))
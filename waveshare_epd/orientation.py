@@ -0,0 +1,72 @@
+# *****************************************************************************
+# * | File        :	  orientation.py
+# * | Function    :   Shared image orientation helpers for the panel drivers
+# * | Info        :
+# *----------------
+# * | Lossless 90/180/270 degree rotation and mirroring through
+# * | Image.transpose, shared by every getbuffer() and by the web app.
+# ******************************************************************************/
+
+import logging
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Counter-clockwise, matching Image.rotate()
+ROTATIONS = {
+    0: None,
+    90: Image.ROTATE_90,
+    180: Image.ROTATE_180,
+    270: Image.ROTATE_270,
+}
+
+MIRRORS = {
+    "none": None,
+    "horizontal": Image.FLIP_LEFT_RIGHT,
+    "vertical": Image.FLIP_TOP_BOTTOM,
+}
+
+
+def normalize_rotation(rotation):
+    try:
+        rotation = int(rotation) % 360
+    except (TypeError, ValueError):
+        rotation = 0
+    if rotation not in ROTATIONS:
+        logger.warning("Unsupported rotation %s, using 0", rotation)
+        return 0
+    return rotation
+
+
+def normalize_mirror(mirror):
+    mirror = (mirror or "none").strip().lower()
+    if mirror not in MIRRORS:
+        logger.warning("Unsupported mirror mode %s, using none", mirror)
+        return "none"
+    return mirror
+
+
+def logical_size(width, height, rotation=0):
+    # Size of the canvas the caller draws on before it is rotated onto the panel
+    if normalize_rotation(rotation) in (90, 270):
+        return height, width
+    return width, height
+
+
+def apply(image, rotation=0, mirror="none"):
+    # Mirror first so "mirror" always refers to the picture as the user sees it
+    method = MIRRORS[normalize_mirror(mirror)]
+    if method is not None:
+        image = image.transpose(method)
+    method = ROTATIONS[normalize_rotation(rotation)]
+    if method is not None:
+        image = image.transpose(method)
+    return image
+
+
+def portrait_to_native(image):
+    # Same result as image.rotate(90, expand=True) without the affine path
+    return image.transpose(Image.ROTATE_90)
+
+### END OF FILE ###
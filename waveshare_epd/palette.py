@@ -0,0 +1,28 @@
+# *****************************************************************************
+# * | File        :	  palette.py
+# * | Function    :   Shared palette helpers for the colour panel drivers
+# * | Info        :
+# *----------------
+# * | Palette images are built once per driver class (EPD.PALETTE_IMAGE)
+# * | instead of on every getbuffer() call.
+# ******************************************************************************/
+
+from PIL import Image
+
+
+def palette_image(colors):
+    # 1x1 "P" image usable as Image.quantize(palette=...). Unused codes (None)
+    # and the slots past the end repeat the first colour; quantize() resolves
+    # ties to the lowest index, so it never emits them.
+    first = tuple(colors[0])
+    flat = tuple(channel for rgb in colors for channel in (rgb or first))
+    pal_image = Image.new("P", (1, 1))
+    pal_image.putpalette(flat + first * (256 - len(colors)))
+    return pal_image
+
+
+def quantize(image, pal_image):
+    # Map an image onto the panel palette, dithering like getbuffer() does
+    return image.convert("RGB").quantize(palette=pal_image)
+
+### END OF FILE ###